@@ -0,0 +1,70 @@
+# -*- coding=utf-8 -*-
+# /usr/bin/python
+
+import vigra
+import numpy as np
+from configuration import DEF_CHANNELREDUCTION
+
+# the weights of the red, green and blue channel regarding the luminance
+LUMINANCE_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+def firstChannelImage(image):
+    """
+        Returns the first channel of the image as a view, i.e. without copying.
+    """
+    return image[..., 0:1]
+
+def luminanceImage(image):
+    """
+        Returns the luminance of an rgb image. Images with another number of
+        channels get the mean of their channels.
+    """
+    if image.shape[2] == 3:
+        weights = LUMINANCE_WEIGHTS
+    else:
+        weights = np.ones(image.shape[2], dtype=np.float32)/image.shape[2]
+    return np.tensordot(np.asarray(image, dtype=np.float32), weights, axes=([2], [0]))[..., np.newaxis]
+
+def maxChannelImage(image):
+    """
+        Returns the maximum of the channels of each pixel.
+    """
+    return np.asarray(image).max(axis=2)[..., np.newaxis]
+
+def pcaImage(image):
+    """
+        Returns the projection of each pixel onto the first principal component of
+        the pixel values, i.e. the direction of the largest variance among the
+        channels. The projection is shifted to a minimum of zero.
+    """
+    pixels = np.asarray(image, dtype=np.float64).reshape(-1, image.shape[2])
+    covariance = np.atleast_2d(np.cov(pixels, rowvar=False))
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    component = eigenvectors[:, np.argmax(eigenvalues)]
+    # orient the component such that brighter pixels project higher
+    if component.sum() < 0:
+        component = -component
+    projection = pixels.dot(component)
+    projection -= projection.min()
+    return projection.reshape(image.shape[0], image.shape[1], 1).astype(np.float32)
+
+# the strategies of reducing a multiband image to a scalar image
+CHANNELREDUCTIONS = {'first': firstChannelImage,
+                     'luminance': luminanceImage,
+                     'max': maxChannelImage,
+                     'pca': pcaImage}
+
+def scalarImage(image, strategy=DEF_CHANNELREDUCTION):
+    """
+        Returns the multiband image reduced to a scalar vigra image regarding the
+        given strategy, which is one of CHANNELREDUCTIONS. Scalar images are
+        returned as they are.
+    """
+    if len(image.shape) < 3 or image.shape[2] == 1:
+        return image
+    assert strategy in CHANNELREDUCTIONS, 'the channel reduction must be one of %s' % CHANNELREDUCTIONS.keys()
+    reduced = CHANNELREDUCTIONS[strategy](image)
+    if isinstance(reduced, vigra.VigraArray):
+        # keep views of the image views
+        return reduced.view(vigra.ScalarImage)
+    return vigra.ScalarImage(reduced)
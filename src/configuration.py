@@ -9,6 +9,7 @@ ROOTPATH = os.path.dirname(os.path.abspath(__file__))
 RESOURCEDIR = os.path.normpath(os.path.join(ROOTPATH, '..', 'resources'))
 IMAGEDIR = os.path.join(RESOURCEDIR, 'images')
 ENCDIR = os.path.join(RESOURCEDIR, 'encs')
+SCALESPACEDIR = os.path.join(RESOURCEDIR, 'scalespaces')
 
 TESTIMAGES = ['wavy.png', 'circle.png', 'straight.png']
 TESTIMAGE = TESTIMAGES[random.randint(0, len(TESTIMAGES)-1)]
@@ -24,3 +25,47 @@ DEF_ENCS = [os.path.join(ENCDIR, 'DE421020.000'), os.path.join(ENCDIR, 'DE421010
 #DEF_EXTENERGY = 'GradientDirectionEnergy'
 DEF_EXTENERGY = 'GradientMagnitudeEnergy'
 DEF_SCALESPACEDEPTH = 5
+# the number of splines kept by the spline cache
+DEF_SPLINECACHESIZE = 256
+# the spline of the snakes, either 'smoothing' or the local support 'catmullrom'
+DEF_SPLINEMODE = 'smoothing'
+# the size budget of the on disk scale space cache in bytes
+DEF_SCALESPACECACHESIZE = 2*1024**3
+# the number of threads the levels of a scale space get filtered by
+DEF_SCALESPACETHREADS = 4
+# the number of threads the channels of multi spectral images get filtered
+# with and the edge length (in pixels) of the tiles multi spectral gradients
+# get computed in, which bounds their memory
+DEF_MSTHREADS = 4
+DEF_MSTILESIZE = 512
+# decimate the coarse levels of the scale spaces by 2 per octave
+DEF_SCALESPACEDECIMATION = False
+# the memory budget of the scale space levels in bytes
+DEF_SCALESPACEMEMORY = 1024**3
+# the dtype the scale space levels get stored with, either 'float32' or 'uint16',
+# which quantizes each level between its minimum and maximum
+DEF_SCALESPACEDTYPE = 'float32'
+# how multiband images get reduced to scalar images, either 'first' (channel),
+# 'luminance', 'max' (channel of each pixel) or 'pca' (first principal component)
+DEF_CHANNELREDUCTION = 'first'
+# the number of orientation bins the normals get quantized into by the gradient
+# direction energy, 0 disables the quantization. Each bin costs the memory of a
+# scalar scale space level, but the energies become a lookup per point
+DEF_DIRECTIONBINS = 0
+# how the external energies get sampled, either 'nearest' (pixel), which
+# keeps the snake on the pixel grid, or 'bilinear' or 'bicubic', which
+# interpolate the energies of the neighbouring pixels and allow fractional
+# coordinates and step sizes
+DEF_SAMPLING = 'nearest'
+# the number of samples per segment if a snake integrates the external energy
+# along its contour
+DEF_CONTOURSAMPLES = 8
+# the gradient vector flow energy: sigma of the edge map, regularization and
+# number of iterations of the flow
+DEF_GVFSIGMA = 2.0
+DEF_GVFMU = 0.2
+DEF_GVFITERATIONS = 80
+# the map feature distance energy: distance (in pixels) beyond which the map
+# features don't attract anymore and the weight of the distance energy
+DEF_MAPDISTANCEMAX = 50.0
+DEF_MAPFEATUREWEIGHT = 0.5
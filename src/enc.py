@@ -3,7 +3,63 @@
 
 from osgeo import ogr
 from osgeo.gdal import gdalconst
-import json
+import numpy as np
+
+def geometryVertices(geometry):
+    """
+        Returns the vertices of the given ogr geometry as contiguous (N, 2) float64
+        array of (x, y), read straight from the geometry via GetPoints. The rings
+        of polygons and the parts of multi geometries get concatenated, points
+        have no vertices.
+    """
+    parts = []
+    geometries = [geometry]
+    while geometries:
+        geometry = geometries.pop(0)
+        count = geometry.GetGeometryCount()
+        if count > 0:
+            # rings of a polygon or parts of a multi geometry
+            geometries[0:0] = [geometry.GetGeometryRef(k) for k in range(count)]
+        elif ogr.GT_Flatten(geometry.GetGeometryType()) != ogr.wkbPoint:
+            points = geometry.GetPoints()
+            if points:
+                # drop z of 2.5D geometries
+                parts.append(np.array(points, dtype=np.float64)[:, :2])
+    if not parts:
+        return np.zeros((0, 2))
+    return np.ascontiguousarray(np.concatenate(parts))
+
+def stackVertices(arrays):
+    """
+        Returns the given list of (N_k, 2) vertex arrays as one contiguous (N, 2)
+        float64 array along with the (K+1,) array of offsets, i.e. the vertices
+        of feature k are vertices[offsets[k]:offsets[k+1]].
+    """
+    offsets = np.zeros(len(arrays)+1, dtype=np.intp)
+    offsets[1:] = np.cumsum([len(array) for array in arrays])
+    if not arrays:
+        return np.zeros((0, 2)), offsets
+    return np.ascontiguousarray(np.concatenate(arrays)), offsets
+
+def readLayer(layer, geometries=True):
+    """
+        A generator over the features of the given ogr layer. Reads the layer
+        sequentially via ResetReading and GetNextFeature, so no feature gets
+        looked up by its id and only one feature is alive at a time. Yields the
+        vertices of the geometry of each feature (see geometryVertices), or None
+        if it has no geometry or 'geometries' is not set, and the dictionary of
+        its fields.
+    """
+    layer.ResetReading()
+    feature = layer.GetNextFeature()
+    while feature is not None:
+        vertices = None
+        if geometries:
+            geometry = feature.GetGeometryRef()
+            if geometry is not None:
+                vertices = geometryVertices(geometry)
+        yield vertices, feature.items()
+        feature = layer.GetNextFeature()
 
 class ENC(object):
     """
@@ -25,37 +81,48 @@ class ENC(object):
 
     def getFeaturesForLayerByName(self, layername, feature_type=None, feature_value=None):
         """
-            Returns the coordinates for a given layer.
+            Returns the coordinates for a given layer as contiguous (N, 2) float64
+            array of the vertices of all features along with the (K+1,) array of
+            offsets of the K features (see stackVertices).
             Parameters:
                 layername: the name of the according layer e.g.'SLCONS', for more check www.s-57.com
                 feature_type: optional. the name of the feature for which to filter by value
                 feature_value: optional. the value for which to filter the feature_type by
         """
         if not self.hasLayer(layername):
-            return []
+            return stackVertices([])
         
-        layer = self.dataset.GetLayerByName(layername)
         feature_list = []
-        i=0
-        j=0
-        while i < layer.GetFeatureCount():            
-                feature=layer.GetFeature(j)
-                j=j+1
-                if feature:
-                    i=i+1
-                    if feature.GetGeometryRef():
-                        if feature_type == None and feature_value == None: 
-                            feature_list.append(json.loads(feature.GetGeometryRef().ExportToJson()))
-                        elif feature_type != None and feature_value == None:
-                            if feature_type in feature.keys():
-                                feature_list.append(json.loads(feature.GetGeometryRef().ExportToJson()))
-                        #falls nach einem feature type des layers mit bestimmtem Wert gefragt wird
-                        else:
-                            if feature_type in feature.keys():
-                                if feature.GetField(feature_type) == feature_value:
-                                    if feature.GetGeometryRef():
-                                        feature_list.append(json.loads(feature.GetGeometryRef().ExportToJson()))
-        return feature_list    
+        # a single sequential pass over the layer
+        for vertices, attributes in self.readLayer(layername):
+            if vertices is None:
+                continue
+            # only the layer is asked for
+            if feature_type == None and feature_value == None:
+                feature_list.append(vertices)
+            # a feature type of the layer is asked for
+            elif feature_type != None and feature_value == None:
+                if feature_type in attributes:
+                    feature_list.append(vertices)
+            # a feature type of the layer with a certain value is asked for
+            else:
+                if feature_type in attributes and attributes[feature_type] == feature_value:
+                    feature_list.append(vertices)
+        return stackVertices(feature_list)
+
+    def readLayer(self, layername, geometries=True):
+        """
+            Returns a generator over the features of the given layer, which reads
+            the layer sequentially in a single pass (see readLayer) and yields the
+            (N, 2) vertex array, or None, and the dictionary of the fields of each
+            feature. Yields nothing if the layer does not exist.
+            Parameters:
+                layername: the name of the layer to read
+                geometries: optional. whether to read the vertices at all
+        """
+        if not self.hasLayer(layername):
+            return iter([])
+        return readLayer(self.dataset.GetLayerByName(layername), geometries)
 
     def getAllLayerNames(self):
         """
@@ -78,26 +145,12 @@ class ENC(object):
         if not self.hasLayer(layername):
             return []
         
-        # get the layer
-        layer = self.dataset.GetLayerByName(layername)
         # initiate the set of names
         featurenames = set()
-        features = []
-        i = 0
-        j = 0
-        # iterate over the layer
-        while i < layer.GetFeatureCount():
-            j += 1
-            feature = layer.GetFeature(j)
-            if feature:
-                i += 1
-                # and collect it's features
-                features.append(feature)
-        # iterate over each feature
-        for feature in features:
-            for key in feature.keys():
-                # and collect the names of its fields
-                featurenames.add(key)
+        # iterate over the layer without reading the geometries
+        for vertices, attributes in self.readLayer(layername, geometries=False):
+            # and collect the names of its fields
+            featurenames.update(attributes.keys())
         return featurenames
     
     def getValuesForField(self, layername, fieldname):
@@ -110,27 +163,14 @@ class ENC(object):
         if not self.hasLayer(layername):
             return []
         
-        # get the layer
-        layer = self.dataset.GetLayerByName(layername)
         # initiate the set of values
         values = set()
-        #featurenames = set()
-        features = []
-        i = 0
-        j = 0
-        # iterate over the layer
-        while i < layer.GetFeatureCount():
-            j += 1
-            feature = layer.GetFeature(j)
-            if feature:
-                i += 1
-                # and collect its features
-                features.append(feature)
-        # iterate over the features
-        for feature in features:
-            if not fieldname == '':
-                # and collect the values for the given field
-                values.add(feature.GetField(fieldname))
+        if fieldname == '':
+            return values
+        # iterate over the layer without reading the geometries
+        for vertices, attributes in self.readLayer(layername, geometries=False):
+            # and collect the values for the given field
+            values.add(attributes.get(fieldname))
         return values
                 
     def toLineString(self, l):
@@ -5,8 +5,78 @@ import vigra
 import numpy as np
 from scipy.linalg import norm
 import math
-from configuration import DEF_SCALESPACEDEPTH
+from configuration import DEF_SCALESPACEDEPTH, DEF_DIRECTIONBINS, DEF_SAMPLING, DEF_GVFSIGMA, DEF_GVFMU, DEF_GVFITERATIONS, DEF_MAPDISTANCEMAX, \
+                          DEF_MAPFEATUREWEIGHT
 from msgradients import *
+from channels import scalarImage
+from gvf import gradientVectorFlow, poissonPotential
+from regions import columnSums, polygonSums, movedPolygonSums
+from scipy.ndimage import distance_transform_edt
+from scalespace import scalespacecache, scalespacemanager, getScaleSpace, levelFactor, levelIndices, GradientMagnitudeFilter, GradientVectorFilter, MSMaxGradientFilter
+
+def firstChannel(values):
+    """
+        Returns the first channel of an (N, ...) array of pixel values, i.e. the
+        values themselves if the image is scalar.
+    """
+    values = np.asarray(values)
+    # index instead of reshape, which fails on an empty batch
+    return values[(slice(None),) + (0,)*(values.ndim-1)]
+
+def bilinearSample(image, xs, ys):
+    """
+        Returns the bilinear interpolation of the (W, H, ...) array image at the
+        float coordinates xs and ys, which must be within the image bounds.
+    """
+    w, h = image.shape[0], image.shape[1]
+    x0 = np.clip(np.floor(xs).astype(np.intp), 0, w-1)
+    y0 = np.clip(np.floor(ys).astype(np.intp), 0, h-1)
+    x1 = np.minimum(x0+1, w-1)
+    y1 = np.minimum(y0+1, h-1)
+    # broadcast the fractions over further axes of the image, e.g. channels
+    extra = (slice(None),) + (np.newaxis,)*(image.ndim-2)
+    fx = (xs - x0)[extra]
+    fy = (ys - y0)[extra]
+    return image[x0, y0]*(1-fx)*(1-fy) + image[x1, y0]*fx*(1-fy) + \
+           image[x0, y1]*(1-fx)*fy + image[x1, y1]*fx*fy
+
+def interpolationWeights(fractions, sampling):
+    """
+        Returns the (N, K) array of the weights of the K neighbouring pixels on
+        one axis, starting at the offset returned along, for the (N,) array of
+        fractional parts of the coordinates. 'sampling' is either 'bilinear'
+        (K = 2, offset 0) or 'bicubic' (K = 4, offset -1, the cubic convolution
+        kernel of Keys).
+    """
+    t = fractions[:, np.newaxis]
+    if sampling == 'bilinear':
+        return np.hstack((1 - t, t)), 0
+    t2 = t**2
+    t3 = t**3
+    return np.hstack((-0.5*t3 + t2 - 0.5*t,
+                      1.5*t3 - 2.5*t2 + 1,
+                      -1.5*t3 + 2*t2 + 0.5*t,
+                      0.5*t3 - 0.5*t2)), -1
+
+def rasterizeLinestrings(shape, linestrings):
+    """
+        Returns a boolean image of the given shape in which the pixels covered by
+        the given linestrings, i.e. lists of image coordinates, are set.
+    """
+    raster = np.zeros(shape[:2], dtype=bool)
+    for linestring in linestrings:
+        points = np.asarray(linestring, dtype=np.float64).reshape(-1, 2)
+        samples = [points]
+        # sample each segment densely enough to hit every pixel it crosses
+        for start, end in zip(points[:-1], points[1:]):
+            n = int(np.ceil(2*np.sqrt(((end - start)**2).sum()))) + 1
+            t = np.linspace(0, 1, n)[:, np.newaxis]
+            samples.append(start + t*(end - start))
+        samples = np.round(np.vstack(samples)).astype(np.intp)
+        inside = (0 <= samples[:, 0]) & (samples[:, 0] < shape[0]) & \
+                 (0 <= samples[:, 1]) & (samples[:, 1] < shape[1])
+        raster[samples[inside, 0], samples[inside, 1]] = True
+    return raster
 
 class ExternalEnergy(object):
     """
@@ -31,6 +101,19 @@ class ExternalEnergy(object):
                   iteration as the second
                 - must be positive
                 - normal is the unit vector of the normal of snake at the control point
+                
+            energies(xs, ys, iteration=None, normals=None)
+                - optional, the vectorized counterpart of energy()
+                - xs and ys are (N,) integer arrays of coordinates, normals is None
+                  or an (N, 2) array of unit vectors
+                - return an (N,) array of energies, each within [0.0, maximum()]
+                - if it is not overridden energy() gets called for each coordinate
+                
+            forces(xs, ys, iteration=None)
+                - optional, only needed by continuous solvers
+                - xs and ys are (N,) float arrays of coordinates
+                - return an (N, 2) array of the forces at the coordinates, i.e. the
+                  negative energy gradient scaled to a magnitude within [0, 1]
                   
         In order to provide sane and valid input and return values the following method
         and attribute should be accessed:
@@ -41,26 +124,39 @@ class ExternalEnergy(object):
             The energy value should be accessed via 'getEnergy(coordinate, iteration)',
             where coordinate is a 2-tuple of ints and iteration is facultative and a
             2-tuple of ints as well.
+            
+            The energy values of many coordinates at once should be accessed via
+            'getEnergies(points, normals, iteration)', where points is an (N, 2)
+            array of coordinates.
     """
     
     def __init__(self, image):
         assert isinstance(image, vigra.Image) 
         self.image = image
+        # a subclass may set a ScaleSpace, the scale space related methods then
+        # refer to it
+        self.scalespace = None
+        # a subclass may have a region term, see regionEnergy
+        self.regions = False
+        # either 'nearest', 'bilinear' or 'bicubic', see getEnergies
+        self.sampling = DEF_SAMPLING
         self.max = self.getMax()
         
     def getEnergy(self, coordinate, iteration=None, normal=None):
         """
             Returns the external energy at the given image coordinates as float.
-            'iteration' is optional.
+            'iteration' is optional. The coordinates must be integers unless
+            the energy gets interpolated (see getEnergies).
         """
         assert len(coordinate) == 2, 'the coordinate must be a 2-tuple'
         x = coordinate[0]
         y = coordinate[1]
-        assert isinstance(x, int) and isinstance(y, int), 'the coordinate values must be integers'
+        if self.sampling == 'nearest':
+            assert isinstance(x, int) and isinstance(y, int), 'the coordinate values must be integers'
         
         imagewidth = self.image.shape[0]
         imageheight = self.image.shape[1]
-        assert x in range(imagewidth) and y in range(imageheight), 'the coordinate %s,%s must be within the image bounds' % (x,y)
+        assert 0 <= x < imagewidth and 0 <= y < imageheight, 'the coordinate %s,%s must be within the image bounds' % (x,y)
         
         if not iteration is None:
             assert 0 < iteration[1] <= iteration[0], 'the current iteration-count must be within zero and the total number of iterations'
@@ -70,7 +166,12 @@ class ExternalEnergy(object):
             assert len(normal) == 2, 'the normal must be a 2-tuple'
             assert isinstance(normal[0], float) and isinstance(normal[1], float), 'the values of the normal must be floats'
             
-        energy = self.energy(x, y, iteration, normal)
+        if self.sampling == 'nearest':
+            energy = self.energy(x, y, iteration, normal)
+        else:
+            if not normal is None:
+                normal = [normal]
+            energy = self.interpolatedEnergies(np.array([[x, y]], dtype=np.float64), normal, iteration)[0]
             
         assert not isinstance(energy, bool), 'the energy function may not yet have been implemented'
         if not isinstance(energy, np.ndarray):
@@ -81,23 +182,123 @@ class ExternalEnergy(object):
         
         return energy
     
+    def getEnergies(self, points, normals=None, iteration=None, validate=False):
+        """
+            Returns the external energies at the given (N, 2) array of image
+            coordinates as an (N,) float array. 'normals' is either None or an
+            (N, 2) array of unit vectors, 'iteration' is optional.
+            
+            If 'validate' is set the input and the returned energies get checked
+            once for the whole batch.
+            
+            Unless 'sampling' is 'nearest' the coordinates may be fractional and
+            the energies get interpolated from the neighbouring pixels.
+        """
+        points = np.asarray(points).reshape(-1, 2)
+        xs = points[:, 0].astype(np.intp)
+        ys = points[:, 1].astype(np.intp)
+        if not normals is None:
+            normals = np.asarray(normals, dtype=np.float64).reshape(-1, 2)
+        
+        if validate:
+            if self.sampling == 'nearest':
+                assert np.all(xs == points[:, 0]) and np.all(ys == points[:, 1]), 'the coordinate values must be integers'
+            imagewidth = self.image.shape[0]
+            imageheight = self.image.shape[1]
+            assert np.all((0 <= xs) & (xs < imagewidth) & (0 <= ys) & (ys < imageheight)), 'the coordinates must be within the image bounds'
+            if not iteration is None:
+                assert len(iteration) == 2, 'iteration must be a 2-tuple'
+                assert 0 < iteration[1] <= iteration[0], 'the current iteration-count must be within zero and the total number of iterations'
+            if not normals is None:
+                assert len(normals) == len(points), 'there must be a normal for each coordinate'
+        
+        if self.sampling == 'nearest' or (np.all(xs == points[:, 0]) and np.all(ys == points[:, 1])):
+            energies = np.asarray(self.energies(xs, ys, iteration, normals), dtype=np.float64)
+        else:
+            energies = self.interpolatedEnergies(points, normals, iteration)
+        
+        if validate:
+            assert energies.shape == (len(points),), 'the energies function must return an (N,) array'
+            assert np.all(energies >= 0), 'the energy function must return positive or zero values'
+            assert np.all(energies <= self.max), 'the energy values must be within the [0, maximum] interval'
+        
+        return energies
+    
+    def interpolatedEnergies(self, points, normals, iteration):
+        """
+            Returns the energies at the given (N, 2) array of float coordinates
+            interpolated bilinearly or bicubically regarding 'sampling'. The
+            energies of all neighbouring pixels of all points get computed by a
+            single call of energies(), each with the normal of its point.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        n = len(points)
+        origins = np.floor(points)
+        wx, offset = interpolationWeights(points[:, 0] - origins[:, 0], self.sampling)
+        wy, offset = interpolationWeights(points[:, 1] - origins[:, 1], self.sampling)
+        k = wx.shape[1]
+        neighbours = np.arange(offset, offset+k)
+        xs = np.clip(origins[:, 0:1] + neighbours, 0, self.image.shape[0]-1).astype(np.intp)
+        ys = np.clip(origins[:, 1:2] + neighbours, 0, self.image.shape[1]-1).astype(np.intp)
+        xs = np.repeat(xs[:, :, np.newaxis], k, axis=2).ravel()
+        ys = np.repeat(ys[:, np.newaxis, :], k, axis=1).ravel()
+        if not normals is None:
+            normals = np.repeat(np.asarray(normals, dtype=np.float64).reshape(-1, 2), k*k, axis=0)
+        energies = np.asarray(self.energies(xs, ys, iteration, normals), dtype=np.float64).reshape(n, k, k)
+        energies = np.einsum('nij,ni,nj->n', energies, wx, wy)
+        if self.sampling == 'bicubic':
+            # the cubic kernel may overshoot
+            energies = np.clip(energies, 0, self.max)
+        return energies
+    
+    def getForces(self, points, iteration=None):
+        """
+            Returns the external forces at the given (N, 2) array of float image
+            coordinates as an (N, 2) array. 'iteration' is optional.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        forces = self.forces(points[:, 0], points[:, 1], iteration)
+        assert not isinstance(forces, bool), 'the forces function has not been implemented by %s' % self.__class__.__name__
+        return forces
+    
     def scaleIndex(self, iteration=None):
         """
             Returns the scale index to which iteration refers. If iteration is
             not given defaults to 0.
             
-            !Has to be overriden by subclass!
+            !Has to be overriden by subclass, unless it has a scale space!
         """
-        return 0
+        if self.scalespace is None or iteration is None:
+            return 0
+        return self.scalespace.scaleIndex(iteration)
     
     def scalestep(self, iteration=None):
         """
             Returns True if a step inside the scale space has just been made,
             otherwise False.
             
-            !Has to be overriden by subclass!
+            !Has to be overriden by subclass, unless it has a scale space!
         """
-        return False
+        if self.scalespace is None or iteration is None:
+            return False
+        return self.scalespace.scalestep(iteration)
+    
+    def setMapFeatures(self, mapfeatures):
+        """
+            Provides the map features, i.e. a list of S57MapFeatureItems whose
+            coordinates are lists of linestrings in image coordinates. May be
+            overridden by subclass which use the map features as a prior.
+        """
+        pass
+    
+    def prefetch(self):
+        """
+            Computes everything the energy needs for an optimization at once, e.g.
+            all levels of the scale space, which otherwise get computed upon their
+            first access. May be overridden by subclass.
+        """
+        if self.scalespace is not None:
+            self.scalespace.prefetch()
     
     def getStepSize(self, iteration=None):
         """
@@ -110,7 +311,10 @@ class ExternalEnergy(object):
         else:
             stepsize = self.stepsize(iteration)
         assert not isinstance(stepsize, bool), 'the stepsize function may not yet have been implemented'
-        assert isinstance(stepsize, int), 'stepsize() must return an integer'
+        if self.sampling == 'nearest':
+            assert isinstance(stepsize, int), 'stepsize() must return an integer'
+        else:
+            assert isinstance(stepsize, (int, float)) and stepsize > 0, 'stepsize() must return a positive number'
         return stepsize
     
     def getMax(self):
@@ -124,9 +328,15 @@ class ExternalEnergy(object):
     
     def stepsize(self, iteration=None):
         """
-            Step size mock up method that has to be overridden by subclass.
+            Step size mock up method that has to be overridden by subclass,
+            unless it has a scale space.
         """
-        return False
+        if self.scalespace is None:
+            return False
+        if self.sampling != 'nearest' and iteration is not None:
+            # interpolated energies allow fractional steps, i.e. sigma itself
+            return float(self.scalespace.sigmas[int(self.scaleIndex(iteration))])
+        return self.scalespace.stepsize(iteration)
     
     def energy(self, x, y, iteration, normal):
         """
@@ -134,6 +344,37 @@ class ExternalEnergy(object):
         """
         return False
     
+    def energies(self, xs, ys, iteration, normals):
+        """
+            Vectorized energy method that should be overridden by subclass. Falls
+            back to calling energy() for each coordinate.
+        """
+        energies = np.zeros(len(xs))
+        for i in range(len(xs)):
+            if normals is None:
+                normal = None
+            else:
+                normal = normals[i]
+            energies[i] = np.asarray(self.energy(int(xs[i]), int(ys[i]), iteration, normal)).flat[0]
+        return energies
+    
+    def forces(self, xs, ys, iteration=None):
+        """
+            Forces mock up method that may be overridden by subclass.
+        """
+        return False
+    
+    def regionEnergy(self, controlpoints):
+        """
+            Region energy mock up method that may be overridden by subclass. Returns
+            the energy within [0, max] of the region enclosed by the (N, 2) array
+            of control points and the chord from the last to the first one.
+            Subclass overriding it set 'regions' and provide regionStatistics,
+            movedRegionStatistics and statisticsEnergy, which allow to update
+            the region energy incrementally.
+        """
+        return 0.0
+    
     def maximum(self):
         """
             Maximum mock up method that has to be overridden by subclass.
@@ -150,6 +391,9 @@ class IntensityEnergy(ExternalEnergy):
     def energy(self, x, y, iteration=None, normal=None):
         return self.image[x][y]
     
+    def energies(self, xs, ys, iteration=None, normals=None):
+        return firstChannel(self.image[xs, ys])
+    
 class GradientMagnitudeEnergy(ExternalEnergy):
     """
         This a subclass of ExternalEnergy and computes the external energy upon
@@ -165,88 +409,65 @@ class GradientMagnitudeEnergy(ExternalEnergy):
         start = time.time()
         # scale space depth
         self.resolution = DEF_SCALESPACEDEPTH
-        # build the scale space
-        self.scalespace, self.scales = self.buildScaleSpace(resolution=self.resolution)
+        # get the scale space, its levels get computed on demand and are shared
+        # with other energies using the same filter on the same image, the
+        # smoothed images also with the GradientDirectionEnergy
+        self.scalespace = getScaleSpace(scalarImage(self.image), GradientMagnitudeFilter(), self.resolution)
+        self.scales = self.scalespace.sigmas
         print 'done (after %s s)' % (time.time()-start)
         
-    def buildScaleSpace(self, sigma_base=6.0, resolution=10):
-        print 'building scale space'
-        # create scale space
-        scalespace = []
-        scales = []
-        print 'computing image with sigma_base=%s' % sigma_base
-        #
-        #vigra.impex.writeImage(self.image, '/home/max/workspace/SnakeIsland/resources/images/scalespace_orig.png')
-        #
-        ggm_image = vigra.filters.gaussianGradientMagnitude(self.image, sigma_base)
-        ggm_image = vigra.colors.linearRangeMapping(ggm_image)
-        #
-        #vigra.impex.writeImage(ggm_image, '/home/max/workspace/SnakeIsland/resources/images/scalespace_%s.png' % sigma_base)
-        #
-        scalespace.append(ggm_image)
-        scales.append(sigma_base)
-        #sigma_base = sigma_base/2
-        for i in range(1, resolution):
-            sigma = i*sigma_base+sigma_base
-            print 'computing image with sigma=%s' % sigma
-            gs_image = vigra.filters.gaussianSmoothing(ggm_image, sigma)
-            gs_image = vigra.colors.linearRangeMapping(gs_image)
-            scalespace.append(gs_image)
-            scales.append(sigma)
-            #
-            #vigra.impex.writeImage(gs_image, '/home/max/workspace/SnakeIsland/resources/images/scalespace_%s.png' % sigma)
-            #
-        scalespace = np.array(scalespace)   
-        return scalespace, scales
-    
-    def stepsize(self, iteration=None):
-        if iteration == None:
-            return 8
-        index = self.scaleIndex(iteration)
-        return int(self.scales[index])
-        
-    def scalestep(self, iteration):
-        """
-            Returns True if the current iteration is the first on a new image
-            regarding the scale space. Helps to deal with the situation when
-            a new image from the scale space is subject to energy computation.
-        """
-        iterations = iteration[0]
-        current_iter = iteration[1]
-        if self.scaleIndex(iteration) != self.scaleIndex((iterations, current_iter-1)):
-            return True
-        return False
-    
-    def scaleIndex(self, iteration):
-        """
-            Returns the index of the resolution space regarding the given iteration-tuple.
-        """
-        iterations = iteration[0]
-        current_iter = iteration[1]
-        # the scale space has to be spread out over the number of iterations
-        v = iterations/self.resolution
-        if  v == 0:
-            miniscale = np.linspace(0, self.resolution-1, iterations)
-            index = miniscale[current_iter - 1]
-        else:
-            index = (self.resolution - 1) - (current_iter - 1)/v
-        if index == -1:
-            return 0
-        return index    
-    
     def energy(self, x, y, iteration=None, normal=None):
         # if no iteration tuple is provided
         if iteration is None:
             # return the inverted energy
-            ggm_image = self.scalespace[-1]
-            return self.max-ggm_image[x][y]
+            return self.max-self.scalespace.values(-1, x, y)
         
         # iteration tuple is provided
         index = self.scaleIndex(iteration)
-        # select the according image
-        ggm_image = self.scalespace[index]
         # return the inverted energy
-        return self.max - ggm_image[x][y]**2
+        return self.max - self.scalespace.values(index, x, y)**2
+        
+    def energies(self, xs, ys, iteration=None, normals=None):
+        # if no iteration tuple is provided
+        if iteration is None:
+            # return the inverted energies
+            return self.max - firstChannel(self.scalespace.values(-1, xs, ys))
+        
+        # iteration tuple is provided
+        index = self.scaleIndex(iteration)
+        # return the inverted energies
+        return self.max - firstChannel(self.scalespace.values(index, xs, ys))**2
+    
+    def forceField(self, index):
+        """
+            Returns the (W, H, 2) force field of the given scale space level, i.e.
+            the gradient of the squared gradient magnitude, which is the negative
+            gradient of the energy. It is scaled to a maximum magnitude of 1. The
+            force fields get computed on demand and are kept by the scale space
+            manager.
+        """
+        key = (self.scalespace.key, 'forces', int(index))
+        field = scalespacemanager.get(key)
+        if field is None:
+            ggm_image = self.scalespace[index]
+            ggm_image = np.asarray(ggm_image, dtype=np.float64).reshape(ggm_image.shape[0], ggm_image.shape[1], -1)[..., 0]
+            gx, gy = np.gradient(ggm_image**2)
+            field = np.dstack((gx, gy))
+            magnitude = np.sqrt((field**2).sum(axis=-1)).max()
+            if magnitude > 0:
+                field /= magnitude
+            field = field.astype(np.float32)
+            scalespacemanager.put(key, field)
+        return field
+    
+    def forces(self, xs, ys, iteration=None):
+        if iteration is None:
+            index = len(self.scalespace)-1
+        else:
+            index = self.scaleIndex(iteration)
+        # the force field has the resolution of its level
+        factor = float(levelFactor(self.scalespace[index], self.image.shape))
+        return bilinearSample(self.forceField(index), xs/factor, ys/factor)
         
     def maximum(self):
         # the max energy is the highest intensity value present in the image
@@ -257,6 +478,9 @@ class GradientDirectionEnergy(ExternalEnergy):
         This a subclass of ExternalEnergy and computes the external energy upon
         the magnitude of the gaussian image gradient.
         A scale space is generated regarding sigma of the gaussian gradient filter.
+        If 'bins' (DEF_DIRECTIONBINS) is set the normals get quantized into as
+        many orientations and the energies of every orientation are looked up
+        from a (W, H, bins) table per level, which gets built on demand.
     """
     
     def __init__(self, *args, **kwargs):
@@ -265,88 +489,85 @@ class GradientDirectionEnergy(ExternalEnergy):
         super(GradientDirectionEnergy, self).__init__(*args, **kwargs)
         import time
         start = time.time()
-        # turn image into scalar image if it is rgb
-        if isinstance(self.image, vigra.RGBImage):
-            image_ = vigra.ScalarImage(self.image.shape[:2])
-            for x in range(self.image.shape[0]):
-                for y in range(self.image.shape[1]):
-                    image_[x,y] = self.image[x,y][0]
-            self.image = image_
+        # turn image into scalar image if it is rgb or multiband
+        self.image = scalarImage(self.image)
         # scale space depth
         self.resolution = DEF_SCALESPACEDEPTH
-        # build the scale space
-        self.scalespace, self.scales = self.buildScaleSpace(resolution=self.resolution)
+        # get the scale space, its levels get computed on demand and are shared
+        # with other energies using the same filter on the same image, the
+        # smoothed images also with the GradientMagnitudeEnergy
+        self.scalespace = getScaleSpace(self.image, GradientVectorFilter(), self.resolution)
+        self.scales = self.scalespace.sigmas
+        # the number of orientation bins, 0 disables the lookup tables
+        self.bins = DEF_DIRECTIONBINS
+        self.bingrid = None
         print 'done (after %s s)' % (time.time()-start)
         
-    def buildScaleSpace(self, sigma_base=6.0, resolution=10):
-        print 'building scale space'
-        # create scale space
-        scalespace = []
-        scales = []
-        print 'computing image with sigma_base=%s' % sigma_base
-        ggm_image = vigra.filters.gaussianGradient(self.image, sigma_base)
-        ggm_image = vigra.colors.linearRangeMapping(ggm_image, newRange=(-125.0, 125.0))
-        scalespace.append(ggm_image)
-        scales.append(sigma_base)
-        for i in range(1, resolution):
-            sigma = i*sigma_base+sigma_base
-            print 'computing image with sigma=%s' % sigma
-            gs_image = vigra.filters.gaussianGradient(self.image, sigma)
-            gs_image = vigra.colors.linearRangeMapping(gs_image, newRange=(-125.0, 125.0))
-            scalespace.append(gs_image)
-            scales.append(sigma)
-        scalespace = np.array(scalespace)   
-        return scalespace, scales
-    
-    def stepsize(self, iteration=None):
-        if iteration == None:
-            return 8
-        index = self.scaleIndex(iteration)
-        return int(self.scales[index])
-        
-    def scalestep(self, iteration):
+    def orientationBins(self, normals):
         """
-            Returns True if the current iteration is the first on a new image
-            regarding the scale space. Helps to deal with the situation when
-            a new image from the scale space is subject to energy computation.
+            Returns the indices of the orientation bins of the given (N, 2) array
+            of unit normals. Instead of an arctan per normal the bins get looked
+            up from a grid over the rounded normal components, which is fine
+            enough to be off by at most one bin on the bin borders.
         """
-        iterations = iteration[0]
-        current_iter = iteration[1]
-        if self.scaleIndex(iteration) != self.scaleIndex((iterations, current_iter-1)):
-            return True
-        return False
-    
-    def scaleIndex(self, iteration):
+        resolution = self.bins
+        if self.bingrid is None or self.bingrid.shape[0] != 2*resolution+1:
+            components = np.linspace(-1, 1, 2*resolution+1)
+            angles = np.arctan2(components[np.newaxis, :], components[:, np.newaxis])
+            self.bingrid = np.round(angles*self.bins/(2*np.pi)).astype(np.intp) % self.bins
+        cells = np.round((np.asarray(normals).reshape(-1, 2) + 1)*resolution).astype(np.intp)
+        return self.bingrid[cells[:, 0], cells[:, 1]]
+        
+    def directionTable(self, index):
         """
-            Returns the index of the resolution space regarding the given iteration-tuple.
+            Returns the (W, H, bins) table of the energies of level 'index' for the
+            normal of each orientation bin. The tables are kept by the scale space
+            manager.
         """
-        iterations = iteration[0]
-        current_iter = iteration[1]
-        # the scale space has to be spread out over the number of iterations
-        v = iterations/self.resolution
-        if  v == 0:
-            miniscale = np.linspace(0, self.resolution-1, iterations)
-            index = miniscale[current_iter - 1]
-        else:
-            index = (self.resolution - 1) - (current_iter - 1)/v
-        if index == -1:
-            return 0
-        return index    
-    
+        key = (self.scalespace.key, 'directions', self.bins, index)
+        table = scalespacemanager.get(key)
+        if table is None:
+            level = np.asarray(self.scalespace[index], dtype=np.float32)
+            table = np.empty(level.shape[:2] + (self.bins,), dtype=np.float32)
+            for b in range(self.bins):
+                angle = 2*np.pi*b/self.bins
+                dotvalues = math.cos(angle)*level[..., 0] + math.sin(angle)*level[..., 1]
+                table[..., b] = np.where(dotvalues < 0, self.max - dotvalues**2, self.max)
+            scalespacemanager.put(key, table)
+        return table
+        
     def energy(self, x, y, iteration=None, normal=None):
         if normal is None:
             return self.max
+        if self.bins > 0:
+            return self.energies(np.array([x]), np.array([y]), iteration, np.array([normal]))[0]
         if iteration is None:
             index = 0
         else:
             index = self.scaleIndex(iteration)
             
-        image = self.scalespace[index]
-        v = image[x, y]
+        v = self.scalespace.values(index, x, y)
         dotvalue = np.dot(normal, v)
         if dotvalue < 0:
             return self.max - dotvalue**2
         return self.max
+    
+    def energies(self, xs, ys, iteration=None, normals=None):
+        if normals is None:
+            return np.ones(len(xs))*self.max
+        if iteration is None:
+            index = 0
+        else:
+            index = self.scaleIndex(iteration)
+        
+        if self.bins > 0:
+            # a single lookup per point
+            table = self.directionTable(index)
+            xs, ys = levelIndices(table, self.image.shape, xs, ys)
+            return table[xs, ys, self.orientationBins(normals)]
+            
+        dotvalues = np.sum(normals*self.scalespace.values(index, xs, ys), -1)
+        return np.where(dotvalues < 0, self.max - dotvalues**2, self.max)
             
     def maximum(self):
         # the max energy is the highest intensity value present in the image
@@ -367,90 +588,291 @@ class MSGradientMagnitudeEnergy(ExternalEnergy):
         start = time.time()
         # scale space depth
         self.resolution = DEF_SCALESPACEDEPTH
-        # build the scale space
-        self.scalespace, self.scales = self.buildScaleSpace(resolution=self.resolution)
+        # get the scale space, its levels get computed on demand and are shared
+        # with other energies using the same filter on the same image
+        self.scalespace = getScaleSpace(self.image, MSMaxGradientFilter(), self.resolution)
+        self.scales = self.scalespace.sigmas
         print 'done (after %s s)' % (time.time()-start)
         
-    def buildScaleSpace(self, sigma_base=6.0, resolution=10):
-        print 'building scale space'
-        # create scale space
-        scalespace = []
-        scales = []
-        print 'computing image with sigma_base=%s' % sigma_base
-        #
-        #vigra.impex.writeImage(self.image, '/home/max/workspace/SnakeIsland/resources/images/scalespace_orig.png')
-        #
-        ggm_image = msMaxGradient(msGaussianGradient(self.image, sigma_base))
-        #ggm_image = vigra.colors.linearRangeMapping(ggm_image)
-        #
-        #vigra.impex.writeImage(ggm_image, '/home/max/workspace/SnakeIsland/resources/images/scalespace_%s.png' % sigma_base)
-        #
-        scalespace.append(ggm_image)
-        scales.append(sigma_base)
-        #sigma_base = sigma_base/2
-        for i in range(1, resolution):
-            sigma = i*sigma_base+sigma_base
-            print 'computing image with sigma=%s' % sigma
-            gs_image = msMaxGradient(msGaussianGradient(ggm_image, sigma))
-            #gs_image = vigra.colors.linearRangeMapping(gs_image)
-            scalespace.append(gs_image)
-            scales.append(sigma)
-            #
-            #vigra.impex.writeImage(gs_image, '/home/max/workspace/SnakeIsland/resources/images/scalespace_%s.png' % sigma)
-            #
-        scalespace = np.array(scalespace)   
-        return scalespace, scales
+    def energy(self, x, y, iteration=None, normal=None):
+        # if no iteration tuple is provided
+        if iteration is None:
+            # return the inverted energy
+            return self.max - np.sqrt(np.sum(self.scalespace.values(-1, x, y)**2))
+        
+        # iteration tuple is provided
+        index = self.scaleIndex(iteration)
+        # return the inverted energy regarding the squared gradient magnitude
+        return self.max - np.sum(self.scalespace.values(index, x, y)**2)
+        
+    def energies(self, xs, ys, iteration=None, normals=None):
+        # if no iteration tuple is provided
+        if iteration is None:
+            # return the inverted energies
+            return self.max - msVector2ImageMagnitude(self.scalespace.values(-1, xs, ys))
+        
+        # iteration tuple is provided
+        index = self.scaleIndex(iteration)
+        # return the inverted energies regarding the squared gradient magnitudes
+        return self.max - np.sum(self.scalespace.values(index, xs, ys)**2, -1)
+        
+    def maximum(self):
+        # the max energy is the highest intensity value present in the image
+        return self.image.max()**2
     
+class GradientVectorFlowEnergy(ExternalEnergy):
+    """
+        This a subclass of ExternalEnergy and computes the external energy upon
+        the gradient vector flow of the gaussian gradient magnitude of the image.
+        The gradient vector flow diffuses the gradient of the edge map into
+        homogeneous regions, so a snake gets attracted by edges from far away
+        without a scale space.
+        The force field is the gradient vector flow itself, the energy is the
+        inverted scalar potential of the flow, both get computed on demand.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        print 'initialising external energy (GradientVectorFlowEnergy)'
+        # super init
+        super(GradientVectorFlowEnergy, self).__init__(*args, **kwargs)
+        self.field = None
+        self.potential = None
+        
+    def prefetch(self):
+        self.computeFlow()
+        
+    def computeFlow(self):
+        """
+            Computes the normalized gradient vector flow and the energy image
+            derived from its potential, unless it has been done before.
+        """
+        if self.field is not None:
+            return
+        import time
+        start = time.time()
+        print 'computing gradient vector flow'
+        # the edge map is the gradient magnitude scaled to [0, 1]
+        edgemap = vigra.filters.gaussianGradientMagnitude(scalarImage(self.image), DEF_GVFSIGMA)
+        edgemap = np.asarray(edgemap, dtype=np.float64).reshape(edgemap.shape[0], edgemap.shape[1], -1)[..., 0]
+        if edgemap.max() > 0:
+            edgemap /= edgemap.max()
+        field = gradientVectorFlow(edgemap, DEF_GVFMU, DEF_GVFITERATIONS)
+        # the potential increases towards the edges, the energy decreases
+        potential = poissonPotential(field)
+        span = potential.max() - potential.min()
+        if span > 0:
+            self.potential = self.max*(potential.max() - potential)/span
+        else:
+            self.potential = np.zeros(potential.shape)
+        magnitude = np.sqrt((field**2).sum(axis=-1)).max()
+        if magnitude > 0:
+            field /= magnitude
+        self.field = field
+        print 'done (after %s s)' % (time.time()-start)
+        
     def stepsize(self, iteration=None):
-        if iteration == None:
-            return 8
-        index = self.scaleIndex(iteration)
-        return int(self.scales[index])
+        # the flow attracts from far away, thus there is no need to adapt the
+        # step size to a scale
+        return 8
         
-    def scalestep(self, iteration):
+    def energy(self, x, y, iteration=None, normal=None):
+        self.computeFlow()
+        return self.potential[x, y]
+    
+    def energies(self, xs, ys, iteration=None, normals=None):
+        self.computeFlow()
+        return self.potential[xs, ys]
+    
+    def forces(self, xs, ys, iteration=None):
+        self.computeFlow()
+        return bilinearSample(self.field, xs, ys)
+        
+    def maximum(self):
+        # the energy is the potential scaled to [0, 255]
+        return 255.0
+    
+class MapFeatureDistanceEnergy(GradientMagnitudeEnergy):
+    """
+        This a subclass of GradientMagnitudeEnergy and blends its energy with the
+        distance to the map features (see setMapFeatures), e.g. the ENC depth
+        contours a snake got initialized from. Thus the snake does not drift to
+        edges unrelated to the map features.
+        The euclidean distance transform of the rasterized linestrings gets
+        computed once per image and set of map features and is kept by the scale
+        space manager. Distances are capped at DEF_MAPDISTANCEMAX, the distance
+        energy gets weighted by DEF_MAPFEATUREWEIGHT.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        # super init
+        super(MapFeatureDistanceEnergy, self).__init__(*args, **kwargs)
+        self.weight = DEF_MAPFEATUREWEIGHT
+        self.distancemax = DEF_MAPDISTANCEMAX
+        self.linestrings = []
+        self.featurekey = None
+        self.imagekey = None
+        
+    def setMapFeatures(self, mapfeatures):
+        self.linestrings = [linestring for mapfeature in mapfeatures for linestring in mapfeature.coordinates
+                            if len(linestring) > 0]
+        self.featurekey = scalespacecache.subkey(None, [np.asarray(linestring, dtype=np.float64).tostring()
+                                                        for linestring in self.linestrings])
+        
+    def distanceEnergies(self):
         """
-            Returns True if the current iteration is the first on a new image
-            regarding the scale space. Helps to deal with the situation when
-            a new image from the scale space is subject to energy computation.
+            Returns the (W, H) image of the distance energies, i.e. the capped
+            distances to the map features scaled to [0, max], or None if there
+            are no map features.
         """
-        iterations = iteration[0]
-        current_iter = iteration[1]
-        if self.scaleIndex(iteration) != self.scaleIndex((iterations, current_iter-1)):
-            return True
-        return False
+        if not self.linestrings:
+            return None
+        if self.imagekey is None:
+            self.imagekey = scalespacecache.key(self.image)
+        key = (self.imagekey, 'distance', self.featurekey)
+        energies = scalespacemanager.get(key)
+        if energies is None:
+            raster = rasterizeLinestrings(self.image.shape, self.linestrings)
+            if raster.any():
+                distances = distance_transform_edt(~raster)
+                energies = (self.max*np.minimum(distances, self.distancemax)/self.distancemax).astype(np.float32)
+            else:
+                # no map feature within the image, an empty array keeps it from
+                # being rasterized again
+                energies = np.zeros((0, 0), dtype=np.float32)
+            scalespacemanager.put(key, energies)
+        if energies.size == 0:
+            return None
+        return energies
+        
+    def energy(self, x, y, iteration=None, normal=None):
+        energy = super(MapFeatureDistanceEnergy, self).energy(x, y, iteration, normal)
+        distances = self.distanceEnergies()
+        if distances is None:
+            return energy
+        return (1 - self.weight)*energy + self.weight*distances[x, y]
     
-    def scaleIndex(self, iteration):
+    def energies(self, xs, ys, iteration=None, normals=None):
+        energies = super(MapFeatureDistanceEnergy, self).energies(xs, ys, iteration, normals)
+        distances = self.distanceEnergies()
+        if distances is None:
+            return energies
+        return (1 - self.weight)*energies + self.weight*distances[xs, ys]
+    
+    def distanceForceField(self):
         """
-            Returns the index of the resolution space regarding the given iteration-tuple.
+            Returns the (W, H, 2) force field of the distance energies, i.e. their
+            negative gradient scaled to a maximum magnitude of 1, or None if
+            there are no map features.
         """
-        iterations = iteration[0]
-        current_iter = iteration[1]
-        # the scale space has to be spread out over the number of iterations
-        v = iterations/self.resolution
-        if  v == 0:
-            miniscale = np.linspace(0, self.resolution-1, iterations)
-            index = miniscale[current_iter - 1]
-        else:
-            index = (self.resolution - 1) - (current_iter - 1)/v
-        if index == -1:
-            return 0
-        return index    
+        distances = self.distanceEnergies()
+        if distances is None:
+            return None
+        key = (self.imagekey, 'distanceforces', self.featurekey)
+        field = scalespacemanager.get(key)
+        if field is None:
+            gx, gy = np.gradient(-distances.astype(np.float64))
+            field = np.dstack((gx, gy))
+            magnitude = np.sqrt((field**2).sum(axis=-1)).max()
+            if magnitude > 0:
+                field /= magnitude
+            scalespacemanager.put(key, field)
+        return field
+        
+    def forces(self, xs, ys, iteration=None):
+        forces = super(MapFeatureDistanceEnergy, self).forces(xs, ys, iteration)
+        field = self.distanceForceField()
+        if field is None:
+            return forces
+        return (1 - self.weight)*forces + self.weight*bilinearSample(field, xs, ys)
     
-    def energy(self, x, y, iteration=None, normal=None):
-        # if no iteration tuple is provided
-        if iteration is None:
-            # return the inverted energy
-            ggm_image = self.scalespace[-1]
-            return self.max-ggm_image[x][y]
+class ChanVeseRegionEnergy(ExternalEnergy):
+    """
+        This a subclass of ExternalEnergy and computes a region energy in the
+        manner of Chan and Vese, e.g. to separate land from water. The energy is
+        the sum of the squared deviations of the pixels from the mean of their
+        region, inside or outside of the snake closed by the chord from the last
+        to the first control point, relative to the one of the whole image.
+        The sums of I and I**2 inside the polygon are computed from column-wise
+        summed-area tables in O(perimeter), a move of a single control point
+        only re-computes its two adjacent edges. The energy has no point-wise
+        term, so it is meant to be combined with the internal energies of the
+        snake (see Snake.totalEnergy).
+    """
+    
+    def __init__(self, *args, **kwargs):
+        print 'initialising external energy (ChanVeseRegionEnergy)'
+        # super init
+        super(ChanVeseRegionEnergy, self).__init__(*args, **kwargs)
+        self.regions = True
+        self.tables = None
+        self.imagekey = None
         
-        # iteration tuple is provided
-        index = self.scaleIndex(iteration)
-        # select the according image
-        ggm_image = self.scalespace[index]
-        # return the inverted energy
-        return self.max - ggm_image[x][y]**2
+    def prefetch(self):
+        self.regionTables()
+        
+    def regionTables(self):
+        """
+            Returns the column sums of I and I**2 of the scalar image and the
+            (count, sum of I, sum of I**2) array of the whole image. They get
+            computed once per image and are kept by the scale space manager.
+        """
+        if self.imagekey is None:
+            self.imagekey = scalespacecache.key(self.image)
+        key = (self.imagekey, 'regiontables')
+        tables = scalespacemanager.get(key)
+        if tables is None:
+            values = np.asarray(scalarImage(self.image), dtype=np.float64)
+            values = values.reshape(values.shape[0], values.shape[1], -1)[..., 0]
+            totals = np.array([values.size, values.sum(), (values**2).sum()])
+            tables = (columnSums(values), columnSums(values**2), totals)
+            scalespacemanager.put(key, tables)
+        return tables
+        
+    def regionStatistics(self, controlpoints):
+        """
+            Returns the signed (count, sum of I, sum of I**2) array of the pixels
+            within the polygon of the control points.
+        """
+        return polygonSums(self.regionTables(), controlpoints)
+    
+    def movedRegionStatistics(self, statistics, controlpoints, i, point):
+        """
+            Returns the region statistics after moving control point i to point,
+            given the statistics before the move.
+        """
+        return movedPolygonSums(self.regionTables(), statistics, controlpoints, i, point)
+    
+    def statisticsEnergy(self, statistics):
+        """
+            Returns the region energy of the given region statistics.
+        """
+        totals = self.regionTables()[2]
+        # the sign only depends on the orientation of the polygon
+        if statistics[0] < 0:
+            statistics = -statistics
+        deviation = totals[2] - totals[1]**2/totals[0]
+        if deviation <= 0:
+            return 0.0
+        outside = totals - statistics
+        energy = 0.0
+        for count, sum, squares in (statistics, outside):
+            if count > 0:
+                energy += squares - sum**2/count
+        return float(np.clip(self.max*energy/deviation, 0, self.max))
+    
+    def regionEnergy(self, controlpoints):
+        if len(controlpoints) < 3:
+            return 0.0
+        return self.statisticsEnergy(self.regionStatistics(np.asarray(controlpoints, dtype=np.float64)))
+        
+    def stepsize(self, iteration=None):
+        return 4
+        
+    def energy(self, x, y, iteration=None, normal=None):
+        return 0.0
+    
+    def energies(self, xs, ys, iteration=None, normals=None):
+        return np.zeros(len(xs))
         
     def maximum(self):
-        # the max energy is the highest intensity value present in the image
-        return self.image.max()**2
-
+        return 255.0
@@ -3,7 +3,7 @@
 
 from osgeo import ogr, gdal, osr
 from osgeo.gdal import gdalconst
-import json
+from enc import geometryVertices, stackVertices, readLayer
 
 class S57(object):
     """
@@ -25,44 +25,34 @@ class S57(object):
 
     def getFeaturesForLayerByName(self, layername, feature_type=None, feature_value=None):
         """
-            Returns the coordinates for a given layer.
+            Returns the coordinates for a given layer as contiguous (N, 2) float64
+            array of the vertices of all features along with the (K+1,) array of
+            offsets of the K features (see enc.stackVertices).
             Parameters:
                 layername: the name of the according layer e.g.'SLCONS', for more check www.s-57.com
                 feature_type: optional. the name of the feature for which to filter by value
                 feature_value: optional. the value for which to filter the feature_type by
         """
         if not self.hasLayer(layername):
-            return []
+            return stackVertices([])
         
-        layer = self.dataset.GetLayerByName(layername)
         feature_list = []
-        i=0
-        j=0
-        while i < layer.GetFeatureCount():            
-                feature=layer.GetFeature(j)
-                j=j+1
-                if feature:
-                    i=i+1
-                    #print feature
-                    if feature.GetGeometryRef():
-                        #print feature.items()
-                        #falls nur nach dem layer gefragt wird
-                        if feature_type == None and feature_value == None: 
-                            feature_list.append(json.loads(feature.GetGeometryRef().ExportToJson()))
-                            #feature_list.append(feature)
-                        #falls nach einem feature type des layers gefragt wird
-                        elif feature_type != None and feature_value == None:
-                            if feature_type in feature.keys():
-                                feature_list.append(json.loads(feature.GetGeometryRef().ExportToJson()))
-                        #falls nach einem feature type des layers mit bestimmtem Wert gefragt wird
-                        else:
-                            if feature_type in feature.keys():
-                                #print 'mit Value %s' % feature_value
-                                if feature.GetField(feature_type) == feature_value:
-                                    if feature.GetGeometryRef():
-                                        feature_list.append(json.loads(feature.GetGeometryRef().ExportToJson()))
-                                        #feature_list.append(feature)
-        return feature_list    
+        # a single sequential pass over the layer
+        for vertices, attributes in self.readLayer(layername):
+            if vertices is None:
+                continue
+            # only the layer is asked for
+            if feature_type == None and feature_value == None:
+                feature_list.append(vertices)
+            # a feature type of the layer is asked for
+            elif feature_type != None and feature_value == None:
+                if feature_type in attributes:
+                    feature_list.append(vertices)
+            # a feature type of the layer with a certain value is asked for
+            else:
+                if feature_type in attributes and attributes[feature_type] == feature_value:
+                    feature_list.append(vertices)
+        return stackVertices(feature_list)
 
 #    def getCoordinatesForLayerByName(self, layername, feature_type=None, feature_value=None):
 #        if feature_type != None and feature_value == None:
@@ -79,6 +69,20 @@ class S57(object):
 #                result_.append(self.toLineString(item['coordinates']))
 #        return result_
 
+    def readLayer(self, layername, geometries=True):
+        """
+            Returns a generator over the features of the given layer, which reads
+            the layer sequentially in a single pass (see readLayer) and yields the
+            (N, 2) vertex array, or None, and the dictionary of the fields of each
+            feature. Yields nothing if the layer does not exist.
+            Parameters:
+                layername: the name of the layer to read
+                geometries: optional. whether to read the vertices at all
+        """
+        if not self.hasLayer(layername):
+            return iter([])
+        return readLayer(self.dataset.GetLayerByName(layername), geometries)
+
     def getAllLayerNames(self):
         """
             Returns the names of all layers present in the given data.
@@ -100,26 +104,12 @@ class S57(object):
         if not self.hasLayer(layername):
             return []
         
-        # get the layer
-        layer = self.dataset.GetLayerByName(layername)
         # initiate the set of names
         featurenames = set()
-        features = []
-        i = 0
-        j = 0
-        # iterate over the layer
-        while i < layer.GetFeatureCount():
-            j += 1
-            feature = layer.GetFeature(j)
-            if feature:
-                i += 1
-                # and collect it's features
-                features.append(feature)
-        # iterate over each feature
-        for feature in features:
-            for key in feature.keys():
-                # and collect the names of its fields
-                featurenames.add(key)
+        # iterate over the layer without reading the geometries
+        for vertices, attributes in self.readLayer(layername, geometries=False):
+            # and collect the names of its fields
+            featurenames.update(attributes.keys())
         return featurenames
     
     def getValuesForField(self, layername, fieldname):
@@ -132,27 +122,14 @@ class S57(object):
         if not self.hasLayer(layername):
             return []
         
-        # get the layer
-        layer = self.dataset.GetLayerByName(layername)
         # initiate the set of values
         values = set()
-        featurenames = set()
-        features = []
-        i = 0
-        j = 0
-        # iterate over the layer
-        while i < layer.GetFeatureCount():
-            j += 1
-            feature = layer.GetFeature(j)
-            if feature:
-                i += 1
-                # and collect its features
-                features.append(feature)
-        # iterate over the features
-        for feature in features:
-            if not fieldname == '':
-                # and collect the values for the given field
-                values.add(feature.GetField(fieldname))
+        if fieldname == '':
+            return values
+        # iterate over the layer without reading the geometries
+        for vertices, attributes in self.readLayer(layername, geometries=False):
+            # and collect the values for the given field
+            values.add(attributes.get(fieldname))
         return values
                 
     def toLineString(self, l):
@@ -0,0 +1,74 @@
+# -*- coding=utf-8 -*-
+# /usr/bin/python
+
+import numpy as np
+from scipy.fftpack import dct, idct
+
+def dct2(a):
+    """
+        Returns the orthonormal 2d discrete cosine transform (type II) over the
+        first two axes of a.
+    """
+    return dct(dct(a, type=2, norm='ortho', axis=0), type=2, norm='ortho', axis=1)
+
+def idct2(a):
+    """
+        Inverse of dct2.
+    """
+    return idct(idct(a, type=2, norm='ortho', axis=1), type=2, norm='ortho', axis=0)
+
+def laplacianEigenvalues(shape):
+    """
+        Returns the (W, H) array of the eigenvalues of the 5-point laplacian with
+        reflecting (Neumann) boundaries, which gets diagonalized by dct2. All
+        eigenvalues are negative except the one of the constant image, which is 0.
+    """
+    kx = 2*np.cos(np.pi*np.arange(shape[0])/shape[0]) - 2
+    ky = 2*np.cos(np.pi*np.arange(shape[1])/shape[1]) - 2
+    return kx[:, np.newaxis] + ky[np.newaxis, :]
+
+def gradientVectorFlow(edgemap, mu=0.2, iterations=80):
+    """
+        Returns the (W, H, 2) gradient vector flow (Xu & Prince) of the (W, H) edge
+        map, i.e. the field v minimizing
+
+            mu*|grad v|**2 + |grad f|**2 * |v - grad f|**2
+
+        It equals the gradient of the edge map close to edges and gets diffused
+        into homogeneous regions, which widens the capture range of a snake.
+
+        Each iteration solves the diffusion implicitly in the dct domain, i.e.
+        (I - tau*mu*laplacian) v_n+1 = v_n + tau*|grad f|**2 * (grad f - v_n),
+        only the data term is explicit. Thus the time step tau is limited by the
+        data term only and a few iterations diffuse the field over a long range.
+    """
+    edgemap = np.asarray(edgemap, dtype=np.float64)
+    fx, fy = np.gradient(edgemap)
+    c = np.dstack((fx, fy))
+    b = (fx**2 + fy**2)[..., np.newaxis]
+    # the largest time step the explicit data term is stable with
+    bmax = b.max()
+    if bmax == 0:
+        return np.zeros(edgemap.shape + (2,))
+    tau = 1.0/bmax
+    denominator = (1 - tau*mu*laplacianEigenvalues(edgemap.shape))[..., np.newaxis]
+    bc = b*c
+    v = c.copy()
+    for i in range(iterations):
+        v = idct2(dct2(v + tau*(bc - b*v))/denominator)
+    return v
+
+def poissonPotential(field):
+    """
+        Returns the (W, H) scalar potential p whose gradient fits the (W, H, 2)
+        field best in the least squares sense, i.e. the solution of the poisson
+        equation laplacian p = div field with reflecting boundaries, solved in the
+        dct domain. The potential has a mean of 0.
+    """
+    divergence = np.gradient(field[..., 0], axis=0) + np.gradient(field[..., 1], axis=1)
+    eigenvalues = laplacianEigenvalues(divergence.shape)
+    # the mean of the potential is arbitrary
+    eigenvalues[0, 0] = 1.0
+    coefficients = dct2(divergence)/eigenvalues
+    coefficients[0, 0] = 0.0
+    return idct2(coefficients)
@@ -0,0 +1,143 @@
+# -*- coding=utf-8 -*-
+# /usr/bin/python
+
+"""
+    Headless benchmark of the multi spectral gradient kernels. Times each
+    method on a synthetic multi band volume and reports the wall time, the
+    peak memory and the throughput as JSON, optionally compared against a
+    stored baseline, e.g.
+
+        python msbenchmark.py --size 2048 --bands 8 --sigma 2 --output bench.json
+        python msbenchmark.py --size 2048 --bands 8 --sigma 2 --baseline bench.json
+"""
+
+import sys
+import json
+import resource
+from time import time
+from optparse import OptionParser
+from multiprocessing import Process, Queue
+import numpy as np
+
+from msgradients import msGaussianGradient, msMeanGradient, msMaxGradient, msMVGradient, msTiledGradient
+
+# the benchmarked methods: name -> (function of the volume and sigma, whether
+# the gradients are computed beforehand and passed instead of the volume)
+METHODS = {'msGaussianGradient': (lambda vol, sigma: msGaussianGradient(vol, sigma), False),
+           'msMeanGradient': (lambda grad, sigma: msMeanGradient(grad), True),
+           'msMaxGradient': (lambda grad, sigma: msMaxGradient(grad), True),
+           'msMVGradient': (lambda grad, sigma: msMVGradient(grad), True),
+           'msTiledGradient(msMaxGradient)': (lambda vol, sigma: msTiledGradient(vol, sigma, msMaxGradient), False),
+           'msTiledGradient(msMVGradient)': (lambda vol, sigma: msTiledGradient(vol, sigma, msMVGradient), False)}
+
+def syntheticVolume(width, height, bands, seed=0):
+    """
+        Returns a (width, height, bands) float32 volume of noise with a few
+        rectangles of different intensity per band, i.e. with edges the
+        gradients respond to.
+    """
+    random = np.random.RandomState(seed)
+    vol = (random.rand(width, height, bands)*32).astype(np.float32)
+    for i in range(8):
+        x0, x1 = sorted(random.randint(0, width, 2))
+        y0, y1 = sorted(random.randint(0, height, 2))
+        vol[x0:x1, y0:y1] += (random.rand(bands)*200).astype(np.float32)
+    return vol
+
+def peakMemory():
+    """
+        Returns the peak resident memory of the process in MB.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on mac os, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return maxrss/1024.0**2
+    return maxrss/1024.0
+
+def measure(name, vol, sigma, repeat, queue):
+    """
+        Runs method 'name' 'repeat' times and puts the best wall time and the
+        peak memory it allocated on top of its input into the queue. Runs in
+        its own process, so the peaks of the methods don't mix.
+    """
+    func, gradients = METHODS[name]
+    if gradients:
+        data = msGaussianGradient(vol, sigma)
+    else:
+        data = vol
+    before = peakMemory()
+    times = []
+    for i in range(repeat):
+        start = time()
+        result = func(data, sigma)
+        times.append(time() - start)
+        del result
+    queue.put((min(times), peakMemory() - before))
+
+def benchmark(size, bands, sigma, repeat=3, methods=None):
+    """
+        Returns the benchmark results of the given methods, which default to all
+        METHODS, on a synthetic (size, size, bands) volume as dictionary.
+    """
+    if methods is None:
+        methods = sorted(METHODS.keys())
+    vol = syntheticVolume(size, size, bands)
+    megapixels = size*size/1e6
+    results = {'size': size, 'bands': bands, 'sigma': sigma, 'repeat': repeat, 'methods': {}}
+    for name in methods:
+        queue = Queue()
+        process = Process(target=measure, args=(name, vol, sigma, repeat, queue))
+        process.start()
+        seconds, memory = queue.get()
+        process.join()
+        results['methods'][name] = {'seconds': seconds,
+                                    'peak_mb': memory,
+                                    'megapixels_per_second': megapixels/seconds if seconds > 0 else None}
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+        Returns the list of (method, ratio) of the methods whose time exceeds
+        the time of the baseline by more than the tolerance factor, and adds the
+        ratio of the times to each method of the results.
+    """
+    regressions = []
+    for name, result in results['methods'].items():
+        if not name in baseline.get('methods', {}):
+            continue
+        reference = baseline['methods'][name]['seconds']
+        if reference <= 0:
+            continue
+        ratio = result['seconds']/reference
+        result['baseline_ratio'] = ratio
+        if ratio > tolerance:
+            regressions.append((name, ratio))
+    return regressions
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--size', type='int', default=1024, help='edge length of the synthetic volume')
+    parser.add_option('--bands', type='int', default=4, help='number of bands of the synthetic volume')
+    parser.add_option('--sigma', type='float', default=2.0, help='sigma of the gaussian gradient')
+    parser.add_option('--repeat', type='int', default=3, help='runs per method, the best one counts')
+    parser.add_option('--method', action='append', dest='methods', choices=sorted(METHODS.keys()),
+                      help='method to benchmark, may be given multiple times, defaults to all')
+    parser.add_option('--output', help='write the results to this JSON file instead of stdout')
+    parser.add_option('--baseline', help='JSON file of earlier results to compare against')
+    parser.add_option('--tolerance', type='float', default=1.2,
+                      help='time ratio against the baseline which counts as regression')
+    options, args = parser.parse_args()
+
+    results = benchmark(options.size, options.bands, options.sigma, options.repeat, options.methods)
+    regressions = []
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+    for name, ratio in regressions:
+        print >> sys.stderr, 'regression: %s takes %.2f times as long as the baseline' % (name, ratio)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,187 @@
+import vigra as vg
+import numpy as np
+from time import time
+
+from matplotlib import pylab as pl
+from mpl_toolkits.axes_grid1 import ImageGrid
+
+from msgradients import msVector2ImageMagnitude, msVector2ImageAngle, msGaussianGradient, \
+                        msMeanGradient, msMaxGradient, msMVGradient
+
+#Plotting helpers of the multispectral gradients, kept apart from msgradients so
+#the energies don't import matplotlib
+
+
+def plotEdgelList(el, plot_area = None):
+    arr = np.array(el)
+    if plot_area == None:
+        pl.plot(arr[:,0],arr[:,1], ".",markersize=1.4)
+    else:
+        plot_area.plot(arr[:,0],arr[:,1], ".",markersize=1.4)
+
+def msCompareResults(vol, sigma, shrink_factor=0.5, gui=True, edge_quantil=0.05):
+    start = time()
+    grad =  msGaussianGradient(vol, sigma)
+    elapsed = time() - start
+    print "msGaussianGradient took %f seconds to finish" % elapsed
+
+    shp = vol.shape
+    weight = np.array(range(shp[2]))
+    for ch in range(shp[2]/2):
+        grad[...,ch,:] *= weight[ch]
+
+    start = time()
+    mean_g = msMeanGradient(grad)   
+    elapsed = time() - start
+    print "msMeanGradient took %f seconds to finish" % elapsed
+    stddev_g = msVector2ImageMagnitude(np.std(grad,2))
+
+    start = time()
+    max_g = msMaxGradient(grad)    
+    elapsed = time() - start
+    print "msMaxGradient took %f seconds to finish" % elapsed
+
+    start = time()
+    mv_g , semi_major_g, semi_minor_g = msMVGradient(grad)    
+    elapsed = time() - start
+    print "msMVGradient took %f seconds to finish" % elapsed
+        
+    eccentricity_g = np.sqrt(1-semi_minor_g**2/semi_major_g**2)
+    
+    mean_el = np.array(vg.analysis.cannyEdgelList(vg.Vector2Image(mean_g),np.max(msVector2ImageMagnitude(mean_g))*edge_quantil))
+    max_el = np.array(vg.analysis.cannyEdgelList(vg.Vector2Image(max_g),  np.max(msVector2ImageMagnitude(max_g))*edge_quantil))
+    mv_el = np.array(vg.analysis.cannyEdgelList(vg.Vector2Image(mv_g),    np.max(msVector2ImageMagnitude(mv_g))*edge_quantil))
+    
+    if (gui):
+        F_mag = pl.figure()
+        F_mag.clf()     
+        pl.jet()
+        grid_mag = ImageGrid(F_mag, 111, \
+                      nrows_ncols = (1, 3),\
+                      direction="row",\
+                      axes_pad = 0.05,\
+                      add_all=True,\
+                      label_mode = "1",\
+                      share_all = True,\
+                      cbar_location="right",\
+                      cbar_mode="single",\
+                      cbar_size="10%",\
+                      cbar_pad=0.05)
+
+        max_v = np.max(msVector2ImageMagnitude(mv_g))
+        min_v = np.min(msVector2ImageMagnitude(mv_g))
+    
+        import matplotlib.colors
+        norm = matplotlib.colors.normalize(vmax=max_v, vmin=min_v)
+        
+        grid_mag[0].imshow(msVector2ImageMagnitude(mean_g),norm=norm)
+        pl.title("Mean Gradient Mag.")
+    
+        #pl.figure()
+        #pl.subplot(132)
+        grid_mag[1].imshow(msVector2ImageMagnitude(max_g), norm=norm)
+        pl.title("Max Gradient Mag.")
+    
+        #pl.figure()
+        #pl.subplot(133)
+        img_mag = grid_mag[2].imshow(msVector2ImageMagnitude(mv_g), norm=norm)
+        pl.title("MV Gradient Mag.")
+        grid_mag[2].cax.colorbar(img_mag)
+        
+	print 'check'        
+        F_ang = pl.figure()
+        F_ang.clf()     
+        pl.hsv()
+        grid_ang = ImageGrid(F_ang, 111, \
+                      nrows_ncols = (1, 3),\
+                      direction="row",\
+                      axes_pad = 0.05,\
+                      add_all=True,\
+                      label_mode = "1",\
+                      share_all = True,\
+                      cbar_location="right",\
+                      cbar_mode="single",\
+                      cbar_size="10%",\
+                      cbar_pad=0.05)
+            
+        norm = matplotlib.colors.normalize(vmax=180, vmin=-180)
+        grid_ang[0].imshow(msVector2ImageAngle(mean_g), norm=norm)
+        pl.title("Mean Gradient Angle")
+    
+        grid_ang[1].imshow(msVector2ImageAngle(max_g), norm=norm)
+        pl.title("Max Gradient Angle")
+    
+        img_ang = grid_ang[2].imshow(msVector2ImageAngle(mv_g), norm=norm)
+        pl.title("MV Gradient Angle")
+        grid_ang[2].cax.colorbar(img_ang)
+        
+        
+        
+        F_edg = pl.figure()
+        F_edg.clf()     
+        pl.hsv()
+        grid_edg = ImageGrid(F_edg, 111, \
+                      nrows_ncols = (1, 3),\
+                      direction="row",\
+                      axes_pad = 0.05,\
+                      add_all=True,\
+                      label_mode = "1",\
+                      share_all = True,\
+                      cbar_location="right",\
+                      cbar_mode="single",\
+                      cbar_size="10%",\
+                      cbar_pad=0.05)
+        
+        
+        grid_edg[0].axis([0, shp[0]-1, shp[1]-1, 0])
+        grid_edg[1].axis([0, shp[0]-1, shp[1]-1, 0])
+        grid_edg[2].axis([0, shp[0]-1, shp[1]-1, 0])
+        plotEdgelList(mean_el, grid_edg[0])
+        plotEdgelList(max_el,  grid_edg[1])
+        plotEdgelList(mv_el,   grid_edg[2])
+        
+        #pl.figure()
+        #pl.subplot(131,aspect="equal")
+        #pl.axis([0, shp[0]-1, shp[1]-1, 0])
+        #plotEdgelList(mean_el)
+        #pl.title("Mean Gradient Edgel")
+
+        #pl.subplot(132,aspect="equal")
+        #pl.axis([0, shp[0]-1, shp[1]-1, 0])
+        #plotEdgelList(max_el)
+        #pl.title("Max Gradient Edgel")
+
+        #pl.subplot(133,aspect="equal")
+        #pl.axis([0, shp[0]-1, shp[1]-1, 0])
+        #plotEdgelList(mv_el)
+        #pl.title("MV Gradient Edgel")
+    
+    
+        ## MV semi-major and semi-minor axis
+        pl.figure()
+        pl.subplot(121)
+        pl.imshow(semi_major_g)
+        pl.copper()
+        pl.colorbar(shrink=shrink_factor)
+        pl.title("Gradient MV semi-major axis")
+    
+        pl.subplot(122)
+        pl.imshow(semi_minor_g)
+        pl.colorbar(shrink=shrink_factor)
+        pl.title("Gradient MV semi-minor axis")
+        
+        
+        ## Std. dev of MS Gradients vs. Eccentricity of the MV eigenvals
+        pl.figure()
+        pl.subplot(121)
+        pl.imshow(stddev_g)
+        pl.copper()
+        pl.colorbar(shrink=shrink_factor)
+        pl.title("Gradient std. dev.")
+    
+        pl.subplot(122)
+        pl.imshow(eccentricity_g)
+        pl.colorbar(shrink=shrink_factor)
+        pl.title("Gradient MV eccentricity")
+
+	pl.show()
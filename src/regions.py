@@ -0,0 +1,63 @@
+# -*- coding=utf-8 -*-
+# /usr/bin/python
+
+import numpy as np
+
+def columnSums(values):
+    """
+        Returns the (W, H+1) summed-area table of the (W, H) array values along
+        the columns, i.e. entry [x, k] is the sum of values[x, :k]. Thus the first
+        row is 0.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    table = np.zeros((values.shape[0], values.shape[1]+1))
+    np.cumsum(values, axis=1, out=table[:, 1:])
+    return table
+
+def edgeSums(tables, p, q):
+    """
+        Returns the signed (count, sum of I, sum of I**2) array of the pixels
+        below the edge from p to q, where 'tables' are the column sums of I and
+        I**2 (see columnSums). Only the columns x with p[0] <= x < q[0] count,
+        or q[0] <= x < p[0] with a negative sign. Summing up the edges of a
+        closed polygon thus leaves the sums of the pixels inside, whose sign
+        depends on the orientation of the polygon.
+        The costs are linear in the width of the edge, not in the area.
+    """
+    x0, y0 = float(p[0]), float(p[1])
+    x1, y1 = float(q[0]), float(q[1])
+    if x0 == x1:
+        return np.zeros(3)
+    sign = 1 if x0 < x1 else -1
+    w, h = tables[0].shape[0], tables[0].shape[1]-1
+    # the columns which the edge passes, clipped to the image
+    columns = np.arange(max(np.ceil(min(x0, x1)), 0), min(np.ceil(max(x0, x1)), w)).astype(np.intp)
+    if len(columns) == 0:
+        return np.zeros(3)
+    ys = y0 + (columns - x0)*(y1 - y0)/(x1 - x0)
+    rows = np.clip(np.floor(ys).astype(np.intp) + 1, 0, h)
+    return sign*np.array([rows.sum(), tables[0][columns, rows].sum(), tables[1][columns, rows].sum()], dtype=np.float64)
+
+def polygonSums(tables, polygon):
+    """
+        Returns the signed (count, sum of I, sum of I**2) array of the pixels
+        within the polygon, given as an (N, 2) array of points. The polygon gets
+        closed by the edge from the last to the first point.
+    """
+    sums = np.zeros(3)
+    n = len(polygon)
+    for i in range(n):
+        sums += edgeSums(tables, polygon[i-1], polygon[i])
+    return sums
+
+def movedPolygonSums(tables, sums, polygon, i, point):
+    """
+        Returns the signed sums of polygonSums after moving the point i of the
+        polygon to point, given the sums before the move. Only the two edges
+        adjacent to the point get re-computed.
+    """
+    n = len(polygon)
+    previous = polygon[i-1]
+    next = polygon[(i+1) % n]
+    return sums - edgeSums(tables, previous, polygon[i]) - edgeSums(tables, polygon[i], next) \
+                + edgeSums(tables, previous, point) + edgeSums(tables, point, next)
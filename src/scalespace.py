@@ -0,0 +1,673 @@
+# -*- coding=utf-8 -*-
+# /usr/bin/python
+
+import os
+import math
+import hashlib
+import tempfile
+import threading
+import weakref
+import vigra
+import numpy as np
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from configuration import SCALESPACEDIR, DEF_SCALESPACECACHESIZE, DEF_SCALESPACETHREADS, DEF_SCALESPACEMEMORY, \
+                          DEF_SCALESPACEDECIMATION, DEF_SCALESPACEDTYPE
+from msgradients import msGaussianSmoothing, msMaxGradient, msTiledGradient
+
+# the scale spaces in use, keyed by their cache key
+_scalespaces = weakref.WeakValueDictionary()
+
+def gaussianSmoothing(image, sigma):
+    # levels loaded from the scale space cache are plain arrays
+    if not isinstance(image, vigra.VigraArray):
+        image = vigra.Image(image)
+    return vigra.filters.gaussianSmoothing(image, sigma)
+
+class QuantizedLevel(object):
+    """
+        A scale space level stored as uint16 along with a scale and an offset,
+        i.e. the level is data*scale + offset. Indexing dequantizes the indexed
+        values only, np.asarray() the whole level.
+    """
+    
+    def __init__(self, data, scale, offset):
+        self.data = data
+        self.scale = scale
+        self.offset = offset
+        
+    @classmethod
+    def quantize(cls, level):
+        """
+            Quantizes the level to 65536 steps between its minimum and maximum.
+        """
+        level = np.asarray(level, dtype=np.float32)
+        offset = float(level.min())
+        scale = (float(level.max()) - offset)/65535.0
+        if scale == 0:
+            scale = 1.0
+        data = np.round((level - offset)/scale).astype(np.uint16)
+        return cls(data, scale, offset)
+        
+    @property
+    def shape(self):
+        return self.data.shape
+    
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+        
+    def __getitem__(self, index):
+        return (self.data[index]*np.float32(self.scale) + np.float32(self.offset)).astype(np.float32)
+    
+    def __array__(self, dtype=None):
+        level = self[...]
+        if dtype is not None:
+            level = level.astype(dtype)
+        return level
+
+def dequantized(level):
+    """
+        Returns the level as an array, whether it is quantized or not.
+    """
+    if isinstance(level, QuantizedLevel):
+        return np.asarray(level)
+    return level
+
+def levelSize(level):
+    """
+        Returns the number of bytes a scale space level occupies in memory. Memory
+        mapped levels don't count, tuples and lists of arrays count the sum of
+        their elements.
+    """
+    if isinstance(level, (tuple, list)):
+        return sum(levelSize(element) for element in level)
+    if isinstance(level, QuantizedLevel):
+        level = level.data
+    if isinstance(level, np.memmap):
+        return 0
+    return np.asarray(level).nbytes
+
+def asDType(image, dtype):
+    """
+        Returns the image with the given dtype, keeping vigra images vigra images.
+    """
+    if image.dtype == dtype:
+        return image
+    return image.astype(dtype)
+
+def decimationFactor(sigma, sigma_base):
+    """
+        Returns the factor a level of the given sigma may get decimated by, i.e.
+        2 for each octave above sigma_base.
+    """
+    return 2**int(math.floor(math.log(float(sigma)/sigma_base, 2) + 1e-9))
+
+def levelFactor(level, shape):
+    """
+        Returns the factor the given scale space level of an image of the given
+        shape has been decimated by.
+    """
+    return int(round(float(shape[0])/level.shape[0]))
+
+def levelIndices(level, shape, xs, ys):
+    """
+        Returns the indices into the given, possibly decimated, scale space level
+        of an image of the given shape of the image coordinates xs and ys.
+    """
+    factor = levelFactor(level, shape)
+    if factor == 1:
+        return xs, ys
+    xs = np.minimum((xs + factor//2)//factor, level.shape[0]-1)
+    ys = np.minimum((ys + factor//2)//factor, level.shape[1]-1)
+    return xs, ys
+
+def levelValues(level, shape, xs, ys):
+    """
+        Returns the values of the given, possibly decimated, scale space level of
+        an image of the given shape at the image coordinates xs and ys.
+    """
+    xs, ys = levelIndices(level, shape, xs, ys)
+    return level[xs, ys]
+
+class ScaleSpaceCache(object):
+    """
+        A content addressed on disk cache of scale spaces. The levels of a scale
+        space are stored as .npy files, named by a hash of the image bytes and
+        the parameters the scale space has been built with, e.g. the energy
+        class, sigma_base and the scale space depth. Cached levels get memory
+        mapped on load, so reopening the same image or ROI doesn't recompute any
+        gaussian.
+
+        If the files exceed the size budget (in bytes) the least recently used
+        scale spaces get deleted.
+    """
+
+    def __init__(self, directory=SCALESPACEDIR, size=DEF_SCALESPACECACHESIZE):
+        self.directory = directory
+        self.size = size
+
+    def key(self, image, *parameters):
+        """
+            Returns the key of the scale space of the given image regarding the
+            given parameters.
+        """
+        image = np.ascontiguousarray(image)
+        sha = hashlib.sha1()
+        sha.update(repr((image.shape, image.dtype.str) + parameters))
+        sha.update(image.tostring())
+        return sha.hexdigest()
+
+    def subkey(self, key, *parameters):
+        """
+            Returns the key of something derived from 'key' regarding the given
+            parameters, which avoids hashing the image bytes again.
+        """
+        return hashlib.sha1(repr((key,) + parameters)).hexdigest()
+
+    def path(self, key, index):
+        """
+            Returns the path of the file of level 'index' of the scale space 'key'.
+        """
+        return os.path.join(self.directory, '%s_%02d.npy' % (key, index))
+
+    def quantizationPath(self, key, index):
+        """
+            Returns the path of the file of the scale and the offset of level 'index'
+            of the scale space 'key' if it is quantized.
+        """
+        return os.path.join(self.directory, '%s_%02d.q.npy' % (key, index))
+
+    def load(self, key, index):
+        """
+            Returns the memory mapped level 'index' of the scale space 'key' or
+            None if it has not been cached.
+        """
+        path = self.path(key, index)
+        if not os.path.isfile(path):
+            return None
+        quantizationpath = self.quantizationPath(key, index)
+        try:
+            level = np.load(path, mmap_mode='r')
+            if os.path.isfile(quantizationpath):
+                scale, offset = np.load(quantizationpath)
+                level = QuantizedLevel(level, scale, offset)
+        except (IOError, ValueError):
+            return None
+        # mark the level as recently used
+        os.utime(path, None)
+        return level
+
+    def save(self, path, array):
+        """
+            Writes the array to path via a temporary file of its own, so neither
+            a partially written file gets loaded nor do processes storing the
+            same level at once write to the same file.
+        """
+        fd, temppath = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asarray(array))
+            os.rename(temppath, path)
+        except:
+            if os.path.exists(temppath):
+                os.remove(temppath)
+            raise
+
+    def store(self, key, index, level):
+        """
+            Writes level 'index' of the scale space 'key' to disk and evicts old
+            scale spaces if the size budget is exceeded.
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            if isinstance(level, QuantizedLevel):
+                # the scale and the offset have to be there once the level is
+                self.save(self.quantizationPath(key, index), np.array([level.scale, level.offset]))
+                level = level.data
+            self.save(self.path(key, index), level)
+        except (IOError, OSError), e:
+            print 'could not cache the scale space level: %s' % e
+            return
+        self.evict()
+
+    def evict(self):
+        """
+            Deletes the least recently used scale spaces until the cached files
+            fit into the size budget.
+        """
+        # group the files by the scale space they belong to
+        entries = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.npy'):
+                continue
+            path = os.path.join(self.directory, filename)
+            key = filename.rsplit('_', 1)[0]
+            stat = os.stat(path)
+            size, mtime, paths = entries.get(key, (0, 0, []))
+            entries[key] = (size + stat.st_size, max(mtime, stat.st_mtime), paths + [path])
+        total = sum(entry[0] for entry in entries.values())
+        for key, (size, mtime, paths) in sorted(entries.items(), key=lambda item: item[1][1]):
+            if total <= self.size:
+                break
+            for path in paths:
+                os.remove(path)
+            total -= size
+
+    def clear(self):
+        """
+            Deletes all cached scale spaces.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.npy'):
+                os.remove(os.path.join(self.directory, filename))
+
+    def __str__(self):
+        return '<ScaleSpaceCache: %s, budget %s bytes>' % (self.directory, self.size)
+
+# the scale space cache shared by all external energies
+scalespacecache = ScaleSpaceCache()
+
+class ScaleSpaceManager(object):
+    """
+        Keeps the scale space levels of all scale spaces of the process in
+        memory, as long as they fit into the memory budget (in bytes). If the
+        budget is exceeded the least recently used levels get dropped, they get
+        reloaded or recomputed upon their next access. Thus the levels of former
+        images or energies don't accumulate.
+    """
+
+    def __init__(self, size=DEF_SCALESPACEMEMORY):
+        self.size = size
+        self.levels = OrderedDict()
+        self.nbytes = 0
+        # levels get computed by the threads of ScaleSpace.prefetch
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+            Returns the level stored for key or None.
+        """
+        with self.lock:
+            level = self.levels.pop(key, None)
+            if level is not None:
+                # mark the level as recently used
+                self.levels[key] = level
+            return level
+
+    def put(self, key, level):
+        """
+            Stores the level for key and drops the least recently used levels
+            if the memory budget is exceeded.
+        """
+        with self.lock:
+            if key in self.levels:
+                self.nbytes -= levelSize(self.levels.pop(key))
+            self.levels[key] = level
+            self.nbytes += levelSize(level)
+            while self.nbytes > self.size and len(self.levels) > 1:
+                old_key, old_level = self.levels.popitem(last=False)
+                self.nbytes -= levelSize(old_level)
+
+    def clear(self):
+        with self.lock:
+            self.levels.clear()
+            self.nbytes = 0
+
+    def __str__(self):
+        return '<ScaleSpaceManager: %s levels, %s/%s bytes>' % (len(self.levels), self.nbytes, self.size)
+
+# the scale space levels of the whole process
+scalespacemanager = ScaleSpaceManager()
+
+class ScaleSpaceFilter(object):
+    """
+        Defines how the levels of a scale space get computed, see ScaleSpace.
+        
+        If 'based' is set level 0 gets computed by base() and the further
+        levels upon level 0, otherwise all levels upon the image. If 'gradients'
+        is set the levels get computed by gradient(), otherwise they are the
+        smoothed images. Each level finally passes mapping().
+        
+        Filters which are not based all read the same smoothed images of the
+        image, so their scale spaces share the gaussian smoothing.
+    """
+    
+    based = False
+    gradients = False
+    
+    def __init__(self, sigma_base=6.0):
+        self.sigma_base = sigma_base
+        
+    def key(self):
+        """
+            Returns the parameters the levels depend on.
+        """
+        return (self.__class__.__name__, self.sigma_base, self.based, self.gradients)
+    
+    def base(self, image):
+        """
+            Base mock up method that has to be overridden by based filters.
+        """
+        return False
+    
+    def gradient(self, image, sigma):
+        """
+            Gradient mock up method that has to be overridden by gradient filters.
+        """
+        return False
+    
+    def smoothing(self, image, sigma):
+        return gaussianSmoothing(image, sigma)
+    
+    def mapping(self, level):
+        return level
+
+class GradientMagnitudeFilter(ScaleSpaceFilter):
+    """
+        The levels are the range mapped gaussian gradient magnitudes of the
+        image. They get computed upon the same smoothed images as the levels of
+        the GradientVectorFilter.
+    """
+    
+    gradients = True
+    
+    def gradient(self, image, sigma):
+        return vigra.filters.gaussianGradientMagnitude(image, sigma)
+    
+    def mapping(self, level):
+        return vigra.colors.linearRangeMapping(level)
+
+class GradientVectorFilter(ScaleSpaceFilter):
+    """
+        The levels are the gaussian gradients of the image, range mapped to
+        [-125, 125].
+    """
+    
+    gradients = True
+    
+    def gradient(self, image, sigma):
+        return vigra.filters.gaussianGradient(image, sigma)
+    
+    def mapping(self, level):
+        return vigra.colors.linearRangeMapping(level, newRange=(-125.0, 125.0))
+
+class MSMaxGradientFilter(ScaleSpaceFilter):
+    """
+        Level 0 is the multi spectral max gradient of the image, the further
+        levels are the multi spectral max gradients of level 0.
+    """
+    
+    based = True
+    gradients = True
+    
+    def base(self, image):
+        return msTiledGradient(image, self.sigma_base, msMaxGradient)
+    
+    def gradient(self, image, sigma):
+        return msTiledGradient(image, sigma, msMaxGradient)
+    
+    def smoothing(self, image, sigma):
+        return msGaussianSmoothing(image, sigma)
+
+def getScaleSpace(image, filter, resolution, decimate=DEF_SCALESPACEDECIMATION, dtype=DEF_SCALESPACEDTYPE):
+    """
+        Returns the scale space of the image regarding the given filter with
+        'resolution' levels of the sigmas i*sigma_base+sigma_base. Energies
+        asking for the same scale space of the same image share one ScaleSpace
+        object and thus its levels, scale spaces of different filters which are
+        not based share the smoothed images of the image.
+    """
+    sigmas = [i*filter.sigma_base+filter.sigma_base for i in range(resolution)]
+    imagekey = scalespacecache.key(image)
+    key = scalespacecache.subkey(imagekey, filter.key(), tuple(sigmas), decimate, np.dtype(dtype).str)
+    scalespace = _scalespaces.get(key)
+    if scalespace is None:
+        scalespace = ScaleSpace(image, filter, sigmas, decimate, dtype, imagekey, key)
+        _scalespaces[key] = scalespace
+    return scalespace
+
+class ScaleSpace(object):
+    """
+        A scale space whose levels get computed lazily upon their first access
+        and are kept by the scale space manager and the scale space cache. Use
+        getScaleSpace() in order to share scale spaces.
+        
+        The levels get computed incrementally, i.e. the image smoothed with
+        sigma_i is the image smoothed with sigma_i-1 smoothed with
+        sqrt(sigma_i**2 - sigma_i-1**2). Each level only needs the smoothed
+        images of the former levels, thus accessing a level never computes more
+        than the levels up to it. The smoothed images are keyed by the image they
+        are computed from and the sigma, i.e. by the image itself for filters
+        which are not based and by level 0 of the scale space for based filters.
+        Thus e.g. the gradient magnitude and the gradient vector scale spaces of
+        the same image compute the gaussian smoothing once.
+        
+        Parameters:
+            image: the image
+            filter: the ScaleSpaceFilter the levels get computed by
+            sigmas: the increasing sigmas of the levels
+            decimate: if set, the levels get decimated by 2 for each octave
+                      above the first sigma, see levelValues
+            dtype: the dtype the levels are stored with, either a float type or
+                   uint16, which quantizes each level with its own scale and
+                   offset (see QuantizedLevel)
+        
+        Besides the levels a scale space provides the mapping from optimization
+        iterations to levels and a step size for each level.
+    """
+
+    def __init__(self, image, filter, sigmas, decimate=DEF_SCALESPACEDECIMATION, dtype=DEF_SCALESPACEDTYPE,
+                 imagekey=None, key=None):
+        self.image = image
+        self.filter = filter
+        self.sigmas = list(sigmas)
+        self.decimate = decimate
+        self.dtype = np.dtype(dtype)
+        # the dtype of the computations and of the smoothed images
+        if self.dtype == np.uint16:
+            self.floattype = np.dtype(np.float32)
+        else:
+            self.floattype = self.dtype
+        if imagekey is None:
+            imagekey = scalespacecache.key(image)
+        if key is None:
+            key = scalespacecache.subkey(imagekey, filter.key(), tuple(self.sigmas), decimate, self.dtype.str)
+        self.key = key
+        # the step size suggested on each level
+        self.stepsizes = [int(sigma) for sigma in self.sigmas]
+        # the sigmas of the levels computed by smoothing and the key of the
+        # image they get smoothed from
+        if filter.based:
+            self.cascade = self.sigmas[1:]
+            self.sourcekey = (self.key, 0)
+        else:
+            self.cascade = self.sigmas
+            self.sourcekey = imagekey
+
+    def __len__(self):
+        return len(self.sigmas)
+
+    def __getitem__(self, index):
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('scale space index out of range')
+        level = scalespacemanager.get((self.key, index))
+        if level is None:
+            level = scalespacecache.load(self.key, index)
+            if level is None:
+                level = self.computeLevel(index)
+                scalespacecache.store(self.key, index, level)
+            scalespacemanager.put((self.key, index), level)
+        return level
+
+    def values(self, index, xs, ys):
+        """
+            Returns the values of level 'index' at the image coordinates xs and ys.
+        """
+        return levelValues(self[index], self.image.shape, xs, ys)
+
+    def scaleIndex(self, iteration):
+        """
+            Returns the index of the level regarding the given iteration-tuple.
+        """
+        iterations = iteration[0]
+        current_iter = iteration[1]
+        resolution = len(self)
+        # the scale space has to be spread out over the number of iterations
+        v = iterations/resolution
+        if  v == 0:
+            miniscale = np.linspace(0, resolution-1, iterations)
+            index = miniscale[current_iter - 1]
+        else:
+            index = (resolution - 1) - (current_iter - 1)/v
+        if index == -1:
+            return 0
+        return index
+
+    def scalestep(self, iteration):
+        """
+            Returns True if the current iteration is the first on a new level.
+        """
+        iterations = iteration[0]
+        current_iter = iteration[1]
+        if self.scaleIndex(iteration) != self.scaleIndex((iterations, current_iter-1)):
+            return True
+        return False
+
+    def stepsize(self, iteration=None):
+        """
+            Returns the step size of the level regarding the given iteration-tuple.
+        """
+        if iteration == None:
+            return 8
+        return self.stepsizes[int(self.scaleIndex(iteration))]
+
+    def factor(self, k):
+        """
+            Returns the decimation factor of smoothing level k.
+        """
+        if not self.decimate:
+            return 1
+        return decimationFactor(self.cascade[k], self.cascade[0])
+
+    def source(self):
+        """
+            Returns the image the smoothing starts from.
+        """
+        if self.filter.based:
+            return dequantized(self[0])
+        return self.image
+
+    def smoothedKey(self, k):
+        return (self.sourcekey, 'smoothed', self.cascade[k], self.factor(k), self.floattype.str)
+
+    def smoothed(self, k):
+        """
+            Returns the source image smoothed with the sigma of smoothing level k,
+            decimated by the level's factor.
+        """
+        image = scalespacemanager.get(self.smoothedKey(k))
+        if image is None:
+            # start at the closest smoothed image still in memory
+            image, sigma, factor = None, 0.0, 1
+            for j in range(k-1, -1, -1):
+                image = scalespacemanager.get(self.smoothedKey(j))
+                if image is not None:
+                    sigma, factor = self.cascade[j], self.factor(j)
+                    break
+            if image is None:
+                image = self.source()
+            image = self.decimated(image, factor, self.factor(k))
+            image = self.filter.smoothing(image, math.sqrt(self.cascade[k]**2 - sigma**2)/self.factor(k))
+            image = asDType(image, self.floattype)
+            scalespacemanager.put(self.smoothedKey(k), image)
+        return image
+
+    def decimated(self, image, factor, new_factor):
+        """
+            Subsamples the image decimated by factor to new_factor. The image must
+            be smoothed enough.
+        """
+        if new_factor == factor:
+            return image
+        step = new_factor/factor
+        return image[::step, ::step].copy()
+
+    def computeLevel(self, index):
+        """
+            Computes level 'index' regardless of the caches.
+        """
+        if self.filter.based:
+            if index == 0:
+                return self.stored(self.filter.base(self.image))
+            k = index-1
+        else:
+            k = index
+        factor = self.factor(k)
+        if not self.filter.gradients:
+            level = self.smoothed(k)
+        else:
+            # the gradient is computed upon the image smoothed with the former sigma
+            if k == 0:
+                image, sigma, image_factor = self.source(), 0.0, 1
+            else:
+                image, sigma, image_factor = self.smoothed(k-1), self.cascade[k-1], self.factor(k-1)
+            image = self.decimated(image, image_factor, factor)
+            level = self.filter.gradient(image, math.sqrt(self.cascade[k]**2 - sigma**2)/factor)
+            # gradients on decimated images refer to the decimated pixels
+            if factor > 1:
+                level = level/factor
+        return self.stored(self.filter.mapping(level))
+    
+    def stored(self, level):
+        """
+            Returns the level the way it gets stored.
+        """
+        if self.dtype == np.uint16:
+            return QuantizedLevel.quantize(level)
+        return asDType(level, self.dtype)
+
+    def prefetch(self, threads=DEF_SCALESPACETHREADS):
+        """
+            Makes all levels available at once. The smoothing is sequential, but
+            the levels are independent of each other and get computed by a thread
+            pool, as the vigra filters release the GIL.
+        """
+        pool = ThreadPool(threads)
+        results = {}
+        for index in range(len(self)):
+            if scalespacemanager.get((self.key, index)) is not None:
+                continue
+            level = scalespacecache.load(self.key, index)
+            if level is not None:
+                scalespacemanager.put((self.key, index), level)
+                continue
+            if self.filter.based:
+                if index == 0:
+                    # the further levels depend on level 0
+                    self[0]
+                    continue
+                k = index-1
+            else:
+                k = index
+            # compute the smoothed image the level depends on in order
+            if not self.filter.gradients:
+                self.smoothed(k)
+            elif k > 0:
+                self.smoothed(k-1)
+            results[index] = pool.apply_async(self.computeLevel, (index,))
+        for index in sorted(results):
+            level = results[index].get()
+            scalespacecache.store(self.key, index, level)
+            scalespacemanager.put((self.key, index), level)
+        pool.close()
+        pool.join()
+
+    def __str__(self):
+        return '<ScaleSpace: %s levels, sigmas %s, %s>' % (len(self), self.sigmas, self.filter.__class__.__name__)
@@ -7,7 +7,9 @@ from numpy.linalg import norm
 from scipy.interpolate import splprep, splev
 from scipy.spatial.distance import euclidean
 from PyQt4.QtCore import QPoint
-from spline import Spline
+from spline import CatmullRomSpline, splinecache
+from configuration import DEF_SPLINEMODE, DEF_CONTOURSAMPLES
+from snakeenergy import DeltaEnergy, asControlPointArray, chordNormals, contourTerms, spacingEnergies, curvatureEnergies, dynamicProgrammingMoves, semiImplicitStep
 import itertools
 import time
 from externalenergy import *
@@ -43,7 +45,8 @@ class Snake(object):
             else:
                 self.ExternalEnergy = externalEnergy
         # set startup values
-        self.controlpoints = []
+        # the control points are kept as a contiguous float64 array of shape (N, 2)
+        self.controlpoints = asControlPointArray([])
         self.normals = []
         self.flip = False
         self.contour = []
@@ -59,7 +62,27 @@ class Snake(object):
         self.optimized = False
         self.inner_weight = 1
         self.outer_weight = 1
+        # the weight of the region energy, if the external energy has one
+        self.region_weight = 1
         self.step_size_fixed = False
+        # evaluate trial moves incrementally during the greedy optimization
+        self.incremental = True
+        # integrate the external energy along the contour instead of sampling
+        # it at the control points only, and the number of samples per segment
+        self.contour_integration = False
+        self.contour_samples = DEF_CONTOURSAMPLES
+        # the edge length of the window of candidate moves of the dp optimization
+        self.dp_window = 3
+        # elasticity, rigidity, time step and number of steps per iteration
+        # of the semi-implicit optimization
+        self.kass_alpha = 0.01
+        self.kass_beta = 0.1
+        self.kass_step = 5.0
+        self.kass_iterations = 10
+        # either 'smoothing' for a smoothing spline or 'catmullrom' for a local
+        # support spline, which gets patched when a control point moves
+        self.spline_mode = DEF_SPLINEMODE
+        self.spline = None
         
         self.bestenergy_debug = 0
     
@@ -72,8 +95,7 @@ class Snake(object):
             been added.
         """
         # compute the contour and normals
-        spline = Spline()
-        spline.addControlPoints(*self.controlpoints)
+        spline = self.getSpline()
         lencontrolpoints = len(self.controlpoints)
         self.contour = spline.interpolation
         self.normals = spline.normals
@@ -82,9 +104,9 @@ class Snake(object):
         #if self.flip:
         #    self.normals = map(lambda n: rotateVector(n, angle=pi), self.normals)
         
-        # compute the energies
-        self.spacing = self.spacingEnergy(self.controlpoints)
-        self.curvature = self.curvatureEnergy(self.controlpoints)
+        # compute the energies, the internal ones along with each single term
+        self.spacing, self.spc_energies = spacingEnergies(self.controlpoints, self.goal_length)
+        self.curvature, self.crv_energies = curvatureEnergies(self.controlpoints)
         self.external = self.externalEnergy(self.controlpoints)
         self.energy = self.totalEnergy(self.controlpoints)
         
@@ -107,11 +129,40 @@ class Snake(object):
         assert lencontrolpoints == len(self.ext_energies), '%s != %s' % (len(self.controlpoints), len(self.ext_energies))
         #assert len(self.normals) == lencontrolpoints
         
+    def getSpline(self):
+        """
+            Returns the spline through the current control points. In catmullrom
+            mode the snake keeps its own spline, which only gets rebuilt if it
+            doesn't match the control points anymore. Otherwise the spline is
+            taken from the spline cache.
+        """
+        if self.spline_mode == 'catmullrom':
+            if self.spline is None or not np.array_equal(self.spline.controlpoints, self.controlpoints):
+                self.spline = CatmullRomSpline()
+                self.spline.addControlPoints(*self.controlpoints)
+            return self.spline
+        self.spline = None
+        return splinecache.getSpline(self.controlpoints)
+        
+    def getNormalsOf(self, controlpoints):
+        """
+            Returns the (N, 2) array of normals of the spline through the given
+            control points, rotated by 180° if the flip-flag is set.
+        """
+        if self.spline_mode == 'catmullrom':
+            return chordNormals(controlpoints, self.flip)
+        normals = np.asarray(splinecache.getSpline(controlpoints).normals).reshape(-1, 2)
+        if self.flip:
+            normals = -normals
+        return normals
+        
     def setStepSize(self, step_size):
         """
             Sets the step size with which a controlpoint moves upon optimization.
+            The step size may be fractional if the external energy gets
+            interpolated, see ExternalEnergy.getEnergies.
         """
-        assert isinstance(step_size, int)
+        assert isinstance(step_size, int) or (isinstance(step_size, float) and self.ExternalEnergy.sampling != 'nearest')
         self.step_size = step_size
         self.step_directions = [np.array([i[0], i[1]]) for i in [(0,0),
                                                                  (0,step_size),
@@ -140,14 +191,18 @@ class Snake(object):
         """
             Adds a control point to the snake.
         """
-        self.controlpoints.extend(controlpoints)
+        self.controlpoints = np.vstack((self.controlpoints, asControlPointArray(controlpoints)))
+        # a catmullrom spline only refits its last segments
+        if self.spline is not None:
+            self.spline.addControlPoints(*controlpoints)
         self.update()
         
     def reset(self, fullreset=True):
         """
             Resets the snake regarding it's control points.
         """
-        self.controlpoints = []
+        self.controlpoints = asControlPointArray([])
+        self.spline = None
         self.contour = []
         self.ext_energies = []
         self.update()
@@ -156,8 +211,9 @@ class Snake(object):
         
     def totalEnergy(self, controlpoints):
         """
-            Returns the sum of the internal and the external energy. The internal
-            energy gets approximately ampped into the same range of values as the
+            Returns the sum of the internal, the external and the region energy
+            (see ExternalEnergy.regionEnergy). The internal energy gets
+            approximately ampped into the same range of values as the
             external energy. The external range of values is known. The internal
             range of values is theoretically unbound but limited in practice.
         """
@@ -170,8 +226,12 @@ class Snake(object):
         # external is within [0, self.ExternalEnergy.max]
         external = self.externalEnergy(controlpoints)
         
-        # return the sum of the scaled internal and the external energy
-        return self.ExternalEnergy.max*(internal/internal_max)*self.inner_weight + external*self.outer_weight
+        # the region energy is within [0, self.ExternalEnergy.max] as well
+        region = self.ExternalEnergy.regionEnergy(asControlPointArray(controlpoints))
+        
+        # return the sum of the scaled internal, the external and the region energy
+        return self.ExternalEnergy.max*(internal/internal_max)*self.inner_weight + external*self.outer_weight + \
+               region*self.region_weight
     
     def spacingEnergy(self, controlpoints):
         """
@@ -181,31 +241,7 @@ class Snake(object):
             far away from each other, but settles within 0 and n-1 in practice, where
             n ist the number of control points. 
         """
-        # only remember each spacing energy if the given control points are
-        # the snakes current control points
-        memorize_energies = np.equal(controlpoints, self.controlpoints).all()
-        # reset the spacing energy list if necessary
-        if memorize_energies:
-            self.spc_energies = []
-        
-        spacing = 0.0
-        # iterate over the adjacent control points
-        for i in range(len(controlpoints)):
-            if i < len(controlpoints)-1:
-                ci = controlpoints[i]
-                ci_next = controlpoints[i+1]
-                
-                # compute the distance between the two points
-                di = (ci_next[0]-ci[0], ci_next[1]-ci[1])
-                di_abs = sqrt(di[0]**2 + di[1]**2)
-                current_spacing = ((di_abs/self.goal_length)-1)**2
-                
-                # add to the overall value
-                spacing += current_spacing
-                # safe to list if necessary
-                if memorize_energies:
-                    self.spc_energies.append(current_spacing)
-        return spacing
+        return spacingEnergies(asControlPointArray(controlpoints), self.goal_length)[0]
     
     def curvatureEnergy(self, controlpoints):
         """
@@ -214,36 +250,7 @@ class Snake(object):
             n is the number of control points. The curvature is measured by measuring
             the angles between all three-pairs of control points. 
         """
-        # only remember each curvature energy if the given control points are
-        # the snakes current control points
-        memorize_energies = np.equal(controlpoints, self.controlpoints).all()
-        # reset the curvature energy list if necessary
-        if memorize_energies:
-            self.crv_energies = []
-        
-        curvature = 0.0
-        # iterate over all three pairs of contorl points
-        for i in range(len(controlpoints)):
-            if i < len(controlpoints)-2:
-                ci = controlpoints[i]
-                cj = controlpoints[i+1]
-                ck = controlpoints[i+2]
-                
-                # compute the two vectors
-                dij = (cj[0]-ci[0], cj[1]-ci[1])
-                djk = (ck[0]-cj[0], ck[1]-cj[1])
-                
-                # compute the angle between these two vectors in radians via
-                # the dot product
-                c = dot(dij, djk)/norm(dij)/norm(djk)
-                current_curvature = 1 - c
-                
-                # add 1-angle to the overall value
-                curvature += current_curvature
-                # save energy if necessary:
-                if memorize_energies:
-                    self.crv_energies.append(current_curvature)
-        return curvature
+        return curvatureEnergies(asControlPointArray(controlpoints))[0]
     
     def externalEnergy(self, controlpoints):
         """
@@ -251,56 +258,71 @@ class Snake(object):
             via the provided ExternalEnergy subclass object. The external energy is
             the sum of the external energies at each control point which get multiplied
             by the inverse of the number of control points. 
+            
+            If contour_integration is set the external energy is the mean of the
+            external energy along the contour instead, see contourEnergy.
         """
+        if self.contour_integration and len(controlpoints) > 1:
+            return self.contourEnergy(controlpoints)
+        
         # compute the factor the energy of each control points get's weighed with
-        external = 0.0
         if len(self.controlpoints) > 0:
             factor = float(1)/len(self.controlpoints)
         else:
             factor = 1
         
         # check if the given controlpoints are equal to the current ones
-        if np.equal(controlpoints, self.controlpoints).all():
+        controlpoints = asControlPointArray(controlpoints)
+        if np.array_equal(controlpoints, self.controlpoints):
             # take the current normals
-            normals = self.normals
+            # ACHTUNG! hier müssen die Normalen zur Berechnung gedreht werden,
+            # falls flip es vorgibt
+            normals = self.getNormals()
         else:
             # otherwise calculate the according normals
-            spline = Spline()
-            spline.addControlPoints(*controlpoints)
-            normals = spline.normals
-        
-        # ACHTUNG! hier müssen die Normalen zur Berechnung gedreht werden,
-        # falls flip es vorgibt
-        if self.flip:
-            normals = map(lambda n: rotateVector(n, angle=pi), normals)
+            normals = self.getNormalsOf(controlpoints)
         
+        # compute the energies at all control points at once
+        energies = self.ExternalEnergy.getEnergies(controlpoints,
+                                                   normals=np.asarray(normals).reshape(-1, 2),
+                                                   iteration=self.iteration)
         # only remember each external control point energy if the given control points are
         # the snakes current control points
-        memorize_energies = np.equal(controlpoints, self.controlpoints).all()
-        # reset the controlpointenergy list if necessary
-        if memorize_energies:
-            self.ext_energies = []
+        if np.array_equal(controlpoints, self.controlpoints):
+            self.ext_energies = energies
         
         # sum up the energies at the single control points multiplied by the inverse
         # of the number of control points
-        for i in range(len(controlpoints)):
-            point = controlpoints[i]
-            
-#            if len(normals) > 0:
-#                normal = normals[i]
-#            else:
-#                normal = None
-            normal = normals[i]
-            
-            pointenergy = self.ExternalEnergy.getEnergy(point, iteration=self.iteration, normal=normal)
-            # check wether to save the point energy
-            if memorize_energies:
-                #self.ext_energies.append(self.ExternalEnergy.getEnergy(point))
-                self.ext_energies.append(pointenergy)
-            external += pointenergy * factor
+        external = energies.sum() * factor
         return external
         
-    def optimize(self, goal_length=100, optimization_steps=15):
+    def contourEnergy(self, controlpoints):
+        """
+            Returns the external energy integrated along the Catmull-Rom contour of
+            the control points, i.e. the sum of the integrals along the segments
+            divided by the length of the contour. Each segment gets sampled at
+            contour_samples arc-length-uniform positions, so the snake can't cut
+            across high energies between control points without penalty.
+            Remembers the energy of each control point as the mean along its
+            adjacent segments if the given control points are the current ones.
+        """
+        controlpoints = asControlPointArray(controlpoints)
+        integrals, lengths = contourTerms(self.ExternalEnergy, controlpoints, 0, len(controlpoints)-1,
+                                          self.contour_samples, self.flip, self.iteration)
+        if np.array_equal(controlpoints, self.controlpoints):
+            adjacent = np.zeros(len(controlpoints))
+            adjacent_lengths = np.zeros(len(controlpoints))
+            adjacent[:-1] += integrals
+            adjacent[1:] += integrals
+            adjacent_lengths[:-1] += lengths
+            adjacent_lengths[1:] += lengths
+            self.ext_energies = adjacent/np.maximum(adjacent_lengths, 1e-12)
+        length = lengths.sum()
+        if length > 0:
+            return integrals.sum()/length
+        return 0.0
+        
+    def optimize(self, goal_length=100, optimization_steps=15, engine='greedy'):
         """
             Optimizes the snake to minimize it's energy. 
             
@@ -309,7 +331,11 @@ class Snake(object):
                              default is 100 pixels in the corresponding image.
                 optimization_steps: the number of iterations the whole of the control
                                     point locations get optimized
+                engine: the optimization each iteration performs, either 'greedy'
+                        (greedyOptimize), 'dp' (dynamicProgrammingOptimize) or
+                        'implicit' (implicitOptimize)
         """
+        assert engine in ('greedy', 'dp', 'implicit'), 'engine must be either "greedy", "dp" or "implicit"'
         self.update()
         # start set of control points
         cpoints = {}
@@ -318,6 +344,10 @@ class Snake(object):
             cpoints[j] = i
             j += 1
         
+        # compute everything the external energy needs at once, e.g. the levels
+        # of its scale space
+        self.ExternalEnergy.prefetch()
+        
         # optimization parameters
         self.goal_length = goal_length
         iterations = optimization_steps
@@ -340,8 +370,13 @@ class Snake(object):
             # update the step size if not overridden by fixed step size
             if not self.step_size_fixed:
                 self.setStepSize(self.ExternalEnergy.getStepSize(iteration=self.iteration))
-            # refine all control points with a greedy optimization
-            cpoints = self.greedyOptimize(cpoints)
+            # refine all control points with the chosen optimization
+            if engine == 'dp':
+                cpoints = self.dynamicProgrammingOptimize(cpoints)
+            elif engine == 'implicit':
+                cpoints = self.implicitOptimize(cpoints)
+            else:
+                cpoints = self.greedyOptimize(cpoints)
             energy_before = self.energy
             # partially reset the snake
             self.reset(fullreset = False)
@@ -351,13 +386,14 @@ class Snake(object):
             self.update()
             energy_after = self.energy
             
-            assert cpoints.values() == self.controlpoints, 'ungleich: %s, %s' % (cpoints.values(), self.controlpoints)
+            assert np.array_equal(cpoints.values(), self.controlpoints), 'ungleich: %s, %s' % (cpoints.values(), self.controlpoints)
             assert self.totalEnergy(cpoints.values()) == self.bestenergy_debug, '%s != %s' % (self.totalEnergy(cpoints.values()), self.bestenergy_debug)
             assert self.totalEnergy(self.controlpoints) == self.bestenergy_debug, '%s != %s' % (self.totalEnergy(self.controlpoints), self.bestenergy_debug)
             
             # if this iteration is the first on a new scale
-            # allow the new value to be greater than the one before
-            if not self.ExternalEnergy.scalestep(self.iteration):
+            # allow the new value to be greater than the one before.
+            # the implicit optimization follows the forces, not the total energy
+            if not self.ExternalEnergy.scalestep(self.iteration) and engine != 'implicit':
                 assert energy_before >= energy_after, '%s is not smaller(or equal) than %s' % (energy_after, energy_before)
             
             print '%s. optimized to %s (iteration: (%s, %s), scale_index: %s, scale_step: %s, step_size: %s)' % (i, self.energy, self.iteration[0], self.iteration[1], self.ExternalEnergy.scaleIndex(self.iteration), self.ExternalEnergy.scalestep(self.iteration), self.step_size)
@@ -370,6 +406,7 @@ class Snake(object):
         # calculate the average iteration runtime
         avgruntime = reduce(lambda x, y: x+y, runtimes)/float(len(runtimes))
         print 'optimized after %s secs w/ iteration average of %s secs' % (time()-starttime, avgruntime)
+        print splinecache
         
         print 'ext', self.ext_energies
         print 'spc', self.spc_energies
@@ -382,7 +419,16 @@ class Snake(object):
             Greedily optimizes every control point of the snake. Proceeds one by the
             other over the list of control points. If no improvement for a control
             point can be estimated it does not get moved.
+            
+            If the incremental flag is set the trial moves get evaluated by
+            deltaGreedyOptimize first. Only if it moves nothing or its outcome
+            does not hold up against the total energy every trial move gets
+            evaluated upon the whole snake.
         """
+        if self.incremental:
+            cpoints_ = self.deltaGreedyOptimize(cpoints)
+            if cpoints_ is not None:
+                return cpoints_
         # the currently best known energy is the current energy
         best_energy = self.totalEnergy(cpoints.values())
         best_before = best_energy
@@ -412,7 +458,7 @@ class Snake(object):
                 assert (c1[0], c1[1]) == (cpoints_[i][0], cpoints_[i][1])
             
             # apply the best step to the control point
-            if best_step != None:
+            if best_step is not None:
                 cpoints_[i] = cpoints_[i] + best_step
         
         # ensure saneness
@@ -422,23 +468,151 @@ class Snake(object):
         assert self.totalEnergy(cpoints_.values()) == best_energy, '(%s != %s) the new calculated energy does not equal the best calculated energy' % (self.totalEnergy(cpoints_.values()), best_energy)
         return cpoints_
     
+    def deltaGreedyOptimize(self, cpoints):
+        """
+            Greedily optimizes every control point of the snake like greedyOptimize,
+            but evaluates each trial move via a DeltaEnergy object, i.e. only the
+            energy terms within the window of the moved control point get
+            re-computed and no spline has to be fitted.
+            
+            The outcome is checked against the total energy of the snake once.
+            Returns None if the sweep moved no control point or did not lower the
+            total energy, so the exact sweep gets its chance, otherwise the
+            optimized control points.
+        """
+        best_before = self.totalEnergy(cpoints.values())
+        cpoints_ = cpoints.copy()
+        delta = DeltaEnergy(self, [cpoints_[i] for i in range(len(cpoints_))])
+        best_energy = delta.total()
+        moved = False
+        for i in range(len(cpoints_)):
+            best_step = None
+            best_terms = None
+            # test all possible steps
+            for step in self.step_directions:
+                # only check a step if it ends within the image bounds
+                if self.inImageBound(cpoints_[i] + step):
+                    new, terms = delta.trial(i, cpoints_[i] + step)
+                    # check wether it is a true improvement
+                    if new < best_energy:
+                        best_energy = new
+                        best_step = step
+                        best_terms = terms
+            # apply the best step to the control point
+            if best_step is not None:
+                cpoints_[i] = cpoints_[i] + best_step
+                delta.move(i, cpoints_[i], best_terms)
+                moved = True
+        
+        # the delta energy's normals only approximate the spline normals, thus
+        # the result has to hold up against the total energy and a sweep
+        # without moves does not prove that the exact sweep finds none
+        if not moved:
+            return None
+        best_energy = self.totalEnergy(cpoints_.values())
+        if best_energy >= best_before:
+            return None
+        self.bestenergy_debug = best_energy
+        return cpoints_
+    
+    def dynamicProgrammingOptimize(self, cpoints):
+        """
+            Optimizes all control points of the snake at once by dynamic programming.
+            Each control point may move within a dp_window x dp_window grid of
+            candidates spaced by the step size. The normals are kept fixed during
+            the search, thus the outcome is checked against the total energy of
+            the snake. If it does not hold up a greedy optimization is performed
+            instead.
+        """
+        best_before = self.totalEnergy(cpoints.values())
+        n = len(cpoints)
+        if n == 0:
+            self.bestenergy_debug = best_before
+            return cpoints
+        points = asControlPointArray(cpoints.values())
+        
+        # the candidates of each control point within its window
+        half = self.dp_window/2
+        offsets = np.array([(dx*self.step_size, dy*self.step_size) for dx in range(-half, half+1)
+                                                                   for dy in range(-half, half+1)], dtype=np.float64)
+        m = len(offsets)
+        candidates = points[:, np.newaxis, :] + offsets[np.newaxis, :, :]
+        inside = (0 <= candidates[..., 0]) & (candidates[..., 0] < self.image.shape[0]) & \
+                 (0 <= candidates[..., 1]) & (candidates[..., 1] < self.image.shape[1])
+        
+        # the normals of the current control points
+        if np.array_equal(points, self.controlpoints):
+            normals = self.getNormals()
+        else:
+            normals = self.getNormalsOf(points)
+        normals = np.repeat(np.asarray(normals).reshape(-1, 2), m, axis=0)
+        
+        # sample the external energies of all candidates at once, candidates
+        # outside of the image are sampled at their control point and forbidden
+        samples = np.where(inside[..., np.newaxis], candidates, points[:, np.newaxis, :])
+        externals = self.ExternalEnergy.getEnergies(samples.reshape(-1, 2),
+                                                    normals=normals,
+                                                    iteration=self.iteration).reshape(n, m)
+        externals[~inside] = np.inf
+        
+        # weigh the energies like totalEnergy does
+        internal_max = n-1 + 2*(n-2)
+        internal_weight = self.ExternalEnergy.max*self.inner_weight/float(internal_max)
+        external_weight = self.outer_weight/float(n)
+        indices = dynamicProgrammingMoves(candidates, externals, self.goal_length, internal_weight, external_weight)
+        
+        cpoints_ = {}
+        for i in range(n):
+            cpoints_[i] = candidates[i, indices[i]]
+        best_energy = self.totalEnergy(cpoints_.values())
+        if best_energy > best_before:
+            return self.greedyOptimize(cpoints)
+        self.bestenergy_debug = best_energy
+        return cpoints_
+    
+    def implicitOptimize(self, cpoints):
+        """
+            Moves the control points continuously by kass_iterations steps of the
+            semi-implicit solver of Kass et al., i.e. x <- A^-1 * (x + step*F), where
+            A holds the elasticity and rigidity of the snake and F are the external
+            forces sampled bilinearly at the control points. A gets factorized once
+            per number of control points and parameters, so each step is O(n). 
+            The control points are not bound to the pixel grid.
+        """
+        points = asControlPointArray(cpoints.values())
+        if len(points) == 0:
+            self.bestenergy_debug = self.totalEnergy(points)
+            return cpoints
+        upper = np.array([self.image.shape[0]-1, self.image.shape[1]-1], dtype=np.float64)
+        for step in range(self.kass_iterations):
+            forces = self.ExternalEnergy.getForces(points, iteration=self.iteration)
+            points = semiImplicitStep(points, forces, self.kass_alpha, self.kass_beta, self.kass_step)
+            # keep the control points within the image
+            points = np.clip(points, 0, upper)
+        cpoints_ = {}
+        for i in range(len(points)):
+            cpoints_[i] = points[i]
+        self.bestenergy_debug = self.totalEnergy(cpoints_.values())
+        return cpoints_
+    
     def inImageBound(self, coordinate):
         imagewidth = self.image.shape[0]
         imageheight = self.image.shape[1]
         x = coordinate[0]
         y = coordinate[1]
-        if x in range(imagewidth) and y in range(imageheight):
+        if 0 <= x < imagewidth and 0 <= y < imageheight:
             return True
         return False
     
     def getNormals(self):
         """
             Returns the normals for external use, i.e. painting. The normals get
-            rotated by 180° if the flip-flag is set.
+            rotated by 180° if the flip-flag is set, as (N, 2) array.
         """
+        normals = np.asarray(self.normals).reshape(-1, 2)
         if self.flip:
-            return map(lambda n: rotateVector(n, angle=pi), self.normals)
-        return self.normals
+            normals = -normals
+        return normals
     
     def flipNormals(self):
         """
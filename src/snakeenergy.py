@@ -0,0 +1,416 @@
+# -*- coding=utf-8 -*-
+# /usr/bin/python
+
+import numpy as np
+from scipy.linalg import cholesky_banded, cho_solve_banded
+
+# the factorized system matrices of the semi-implicit solver,
+# keyed by (n, alpha, beta, step)
+_system_matrices = {}
+
+def asControlPointArray(controlpoints):
+    """
+        Returns the given control points as a contiguous float64 array of
+        shape (N, 2).
+    """
+    return np.ascontiguousarray(np.asarray(controlpoints, dtype=np.float64).reshape(-1, 2))
+
+def spacingTerms(d, goal_length):
+    """
+        Returns the spacing energies of the given (..., 2) array of vectors between
+        adjacent control points.
+    """
+    return (np.sqrt((d**2).sum(axis=-1))/goal_length - 1)**2
+
+def curvatureTerms(dij, djk):
+    """
+        Returns the curvature energies, i.e. 1 - cos of the angle, of the given
+        (..., 2) arrays of vectors between the control points of triples.
+    """
+    c = (dij*djk).sum(axis=-1)/np.sqrt((dij**2).sum(axis=-1))/np.sqrt((djk**2).sum(axis=-1))
+    return 1 - c
+
+def spacingEnergies(controlpoints, goal_length):
+    """
+        Returns the spacing energy of the given (N, 2) array of control points
+        and the (N-1,) array of the energies between each pair of adjacent
+        control points.
+    """
+    energies = spacingTerms(np.diff(controlpoints, axis=0), goal_length)
+    return energies.sum(), energies
+
+def curvatureEnergies(controlpoints):
+    """
+        Returns the curvature energy of the given (N, 2) array of control points
+        and the (N-2,) array of the energies of each triple of control points,
+        i.e. 1 - cos of the angle between the two vectors of a triple.
+    """
+    d = np.diff(controlpoints, axis=0)
+    energies = curvatureTerms(d[:-1], d[1:])
+    return energies.sum(), energies
+
+def dynamicProgrammingMoves(candidates, externals, goal_length, internal_weight, external_weight):
+    """
+        Finds the globally optimal set of candidate positions for an open snake
+        by dynamic programming (Amini et al.).
+        
+        Parameters:
+            candidates: (N, M, 2) array of the M candidate positions of each of
+                        the N control points
+            externals: (N, M) array of the external energies at the candidates,
+                       np.inf marks a forbidden candidate
+            goal_length: the goal length of the spacing energy
+            internal_weight: the factor the spacing and curvature energies get
+                             multiplied by
+            external_weight: the factor the external energies get multiplied by
+        
+        As the curvature energy depends on triples of control points the state of
+        the recursion is a pair of candidates of adjacent control points, thus the
+        costs are O(N*M^3). Returns the (N,) array of the chosen candidate indices.
+    """
+    n, m = externals.shape
+    if n == 1:
+        return np.array([np.argmin(externals[0])])
+    
+    # spacing energies of all pairs of candidates of adjacent control points, (N-1, M, M)
+    spacing = spacingTerms(candidates[1:, np.newaxis, :, :] - candidates[:-1, :, np.newaxis, :], goal_length)
+    spacing = np.where(np.isnan(spacing), np.inf, spacing)
+    
+    # cost of the first pair of control points
+    cost = external_weight*(externals[0][:, np.newaxis] + externals[1][np.newaxis, :]) + internal_weight*spacing[0]
+    backpointers = []
+    for i in range(2, n):
+        # curvature energies of all triples of candidates of i-2, i-1 and i, (M, M, M)
+        dij = candidates[i-1][np.newaxis, :, np.newaxis, :] - candidates[i-2][:, np.newaxis, np.newaxis, :]
+        djk = candidates[i][np.newaxis, np.newaxis, :, :] - candidates[i-1][np.newaxis, :, np.newaxis, :]
+        curvature = curvatureTerms(dij, djk)
+        curvature = np.where(np.isnan(curvature), np.inf, curvature)
+        # minimize over the candidates of i-2 for each pair of candidates of i-1 and i
+        total = cost[:, :, np.newaxis] + internal_weight*curvature
+        backpointers.append(np.argmin(total, axis=0))
+        cost = total.min(axis=0) + internal_weight*spacing[i-1] + external_weight*externals[i][np.newaxis, :]
+    
+    # trace the optimal path back from the best final pair
+    indices = np.zeros(n, dtype=int)
+    indices[n-2], indices[n-1] = np.unravel_index(np.argmin(cost), cost.shape)
+    for i in range(n-1, 1, -1):
+        indices[i-2] = backpointers[i-2][indices[i-1], indices[i]]
+    return indices
+
+def chordNormals(controlpoints, flip=False):
+    """
+        Returns the (N, 2) array of normals of the given control points. Each normal
+        is perpendicular to the chord between the adjacent control points, the
+        first and the last point take the chord to their only neighbour. The
+        normals are rotated by 180° if flip is set.
+    """
+    if len(controlpoints) < 2:
+        return np.tile(np.array([1.0, 0.0]), (len(controlpoints), 1))
+    previous = np.vstack((controlpoints[:1], controlpoints[:-1]))
+    next = np.vstack((controlpoints[1:], controlpoints[-1:]))
+    d = next - previous
+    # rotate by 90°
+    normals = np.column_stack((-d[:, 1], d[:, 0]))
+    normals /= np.sqrt((normals**2).sum(axis=1))[:, np.newaxis]
+    if flip:
+        normals = -normals
+    return normals
+
+def catmullRomNeighbours(controlpoints, j):
+    """
+        Returns the four control points the uniform Catmull-Rom segment j, i.e.
+        between the control points j and j+1, depends on as (K, 2) arrays, where
+        j may be an int or an array of K segment indices. The first and the last
+        control point get mirrored neighbours.
+    """
+    j = np.atleast_1d(j)
+    n = len(controlpoints)
+    p1 = controlpoints[j]
+    p2 = controlpoints[j+1]
+    p0 = np.where((j > 0)[:, np.newaxis], controlpoints[np.maximum(j-1, 0)], 2*p1 - p2)
+    p3 = np.where((j+2 < n)[:, np.newaxis], controlpoints[np.minimum(j+2, n-1)], 2*p2 - p1)
+    return p0, p1, p2, p3
+
+def catmullRomPoints(p0, p1, p2, p3, t):
+    """
+        Returns the points of the Catmull-Rom segments given by their neighbours
+        at the parameters t within [0, 1]. The arrays get broadcast.
+    """
+    return 0.5*(2*p1 + (p2-p0)*t + (2*p0-5*p1+4*p2-p3)*t**2 + (-p0+3*p1-3*p2+p3)*t**3)
+
+def catmullRomDerivatives(p0, p1, p2, p3, t):
+    """
+        Returns the first derivatives of the Catmull-Rom segments given by their
+        neighbours at the parameters t within [0, 1]. The arrays get broadcast.
+    """
+    return 0.5*((p2-p0) + 2*(2*p0-5*p1+4*p2-p3)*t + 3*(-p0+3*p1-3*p2+p3)*t**2)
+
+def contourSamples(controlpoints, start, stop, samples, flip=False):
+    """
+        Samples the Catmull-Rom segments start to stop-1 of the given (N, 2)
+        array of control points at 'samples' arc-length-uniform positions each,
+        i.e. at the midpoints of as many pieces of equal length.
+        
+        Returns the (S, samples, 2) arrays of the points and of their unit normals,
+        rotated by 180° if flip is set, and the (S,) array of the arc lengths of
+        the segments. The arc length gets approximated by a polyline of
+        4*samples pieces per segment.
+    """
+    j = np.arange(start, stop)
+    p0, p1, p2, p3 = [p[:, np.newaxis, :] for p in catmullRomNeighbours(controlpoints, j)]
+    # the arc length along a fine polyline of each segment
+    fine = np.linspace(0, 1, 4*samples+1)
+    polyline = catmullRomPoints(p0, p1, p2, p3, fine[np.newaxis, :, np.newaxis])
+    arc = np.zeros((len(j), len(fine)))
+    arc[:, 1:] = np.cumsum(np.sqrt((np.diff(polyline, axis=1)**2).sum(axis=-1)), axis=1)
+    lengths = arc[:, -1]
+    # the parameters of the arc-length-uniform positions
+    positions = (np.arange(samples) + 0.5)/samples
+    arc = arc/np.where(lengths > 0, lengths, 1)[:, np.newaxis]
+    k = np.clip((arc[:, :, np.newaxis] <= positions[np.newaxis, np.newaxis, :]).sum(axis=1) - 1, 0, len(fine)-2)
+    rows = np.arange(len(j))[:, np.newaxis]
+    a = arc[rows, k]
+    b = arc[rows, k+1]
+    fraction = np.where(b > a, (positions[np.newaxis, :] - a)/np.where(b > a, b - a, 1), 0)
+    t = (fine[k] + fraction*(fine[1] - fine[0]))[:, :, np.newaxis]
+    points = catmullRomPoints(p0, p1, p2, p3, t)
+    d = catmullRomDerivatives(p0, p1, p2, p3, t)
+    # rotate the derivatives by 90°
+    normals = np.concatenate((-d[..., 1:2], d[..., 0:1]), axis=-1)
+    normals /= np.maximum(np.sqrt((normals**2).sum(axis=-1)), 1e-12)[..., np.newaxis]
+    if flip:
+        normals = -normals
+    return points, normals, lengths
+
+def contourTerms(energy, controlpoints, start, stop, samples, flip=False, iteration=None):
+    """
+        Returns the integrals of the external energy along the Catmull-Rom
+        segments start to stop-1 of the control points, i.e. the mean of the
+        energies at the samples of each segment (see contourSamples) times its
+        arc length, along with the (S,) array of the arc lengths. All samples get
+        evaluated by a single call of the external energy.
+    """
+    if stop <= start:
+        return np.zeros(0), np.zeros(0)
+    points, normals, lengths = contourSamples(controlpoints, start, stop, samples, flip)
+    # keep the samples within the image
+    upper = np.array([energy.image.shape[0]-1, energy.image.shape[1]-1], dtype=np.float64)
+    points = np.clip(points, 0, upper)
+    energies = energy.getEnergies(points.reshape(-1, 2), normals=normals.reshape(-1, 2), iteration=iteration)
+    return energies.reshape(len(lengths), samples).mean(axis=1)*lengths, lengths
+
+class DeltaEnergy(object):
+    """
+        Keeps the single energy terms of a snake, i.e. the spacing energy of every
+        pair of adjacent control points, the curvature energy of every triple of
+        control points and the external energy at every control point. If the
+        snake integrates the external energy along its contour the external terms
+        are the integrals along the segments between the control points instead
+        (see contourTerms). If the external energy has a region term its
+        statistics get kept as well.
+
+        Moving one control point only changes two spacing terms, three curvature
+        terms, the external terms of the point and its direct neighbours, or of
+        the four segments adjacent to the point, and the two edges of the region
+        polygon adjacent to the point. Thus a
+        trial move gets evaluated by re-computing only that window instead of
+        the whole snake.
+
+        The normals are the chord normals of the control points (see chordNormals).
+        They only depend on the neighbours, which keeps the window of a move local.
+        The energies are scaled and summed up the very same way as in
+        Snake.totalEnergy.
+    """
+
+    def __init__(self, snake, controlpoints):
+        self.snake = snake
+        self.controlpoints = asControlPointArray(controlpoints).copy()
+        # whether the external terms are integrals along the segments
+        self.contour = snake.contour_integration and len(self.controlpoints) >= 2
+        self.refresh()
+
+    def refresh(self):
+        """
+            Recomputes every single energy term and the sums from scratch.
+        """
+        self.spacing, self.spc_energies = spacingEnergies(self.controlpoints, self.snake.goal_length)
+        self.curvature, self.crv_energies = curvatureEnergies(self.controlpoints)
+        if self.contour:
+            self.ext_energies, self.lengths = self.contourTerms(0, len(self.controlpoints)-1)
+            self.length = self.lengths.sum()
+        else:
+            self.ext_energies = self.externalTerms(0, len(self.controlpoints))
+            self.lengths = None
+            self.length = None
+        self.external = self.ext_energies.sum()
+        if self.snake.ExternalEnergy.regions and len(self.controlpoints) >= 3:
+            self.statistics = self.snake.ExternalEnergy.regionStatistics(self.controlpoints)
+        else:
+            self.statistics = None
+
+    def externalTerms(self, start, stop):
+        """
+            Returns the external energies at the control points start to stop-1.
+        """
+        # the normals of the window only depend on one more point on either side
+        lo = max(start-1, 0)
+        normals = chordNormals(self.controlpoints[lo:stop+1], self.snake.flip)[start-lo:stop-lo]
+        return self.snake.ExternalEnergy.getEnergies(self.controlpoints[start:stop],
+                                                     normals=normals,
+                                                     iteration=self.snake.iteration)
+
+    def contourTerms(self, start, stop):
+        """
+            Returns the integrals of the external energy along the segments start
+            to stop-1 and their arc lengths.
+        """
+        return contourTerms(self.snake.ExternalEnergy, self.controlpoints, start, stop,
+                            self.snake.contour_samples, self.snake.flip, self.snake.iteration)
+
+    def window(self, i):
+        """
+            Returns the (start, stop) index ranges of the spacing, curvature and
+            external terms which are affected by moving control point i.
+        """
+        n = len(self.controlpoints)
+        spc = (max(i-1, 0), min(i+1, n-1))
+        crv = (max(i-2, 0), min(i+1, n-2))
+        if self.contour:
+            # a segment depends on the two control points on either side
+            ext = (max(i-2, 0), min(i+2, n-1))
+        else:
+            ext = (max(i-1, 0), min(i+2, n))
+        return spc, crv, ext
+
+    def total(self, spacing=None, curvature=None, external=None, statistics=None, length=None):
+        """
+            Returns the total energy like Snake.totalEnergy does. The sums, the
+            region statistics and the length of the contour default to the
+            currently cached ones.
+        """
+        if spacing is None:
+            spacing = self.spacing
+        if curvature is None:
+            curvature = self.curvature
+        if external is None:
+            external = self.external
+        if statistics is None:
+            statistics = self.statistics
+        if length is None:
+            length = self.length
+        n = len(self.controlpoints)
+        internal_max = n-1 + 2*(n-2)
+        if self.contour:
+            # the integral becomes the mean along the contour
+            if length > 0:
+                factor = 1/length
+            else:
+                factor = 0.0
+        elif n > 0:
+            factor = float(1)/n
+        else:
+            factor = 1
+        internal = spacing + curvature
+        if statistics is None:
+            region = 0.0
+        else:
+            region = self.snake.ExternalEnergy.statisticsEnergy(statistics)
+        return self.snake.ExternalEnergy.max*(internal/internal_max)*self.snake.inner_weight + external*factor*self.snake.outer_weight + \
+               region*self.snake.region_weight
+
+    def trial(self, i, point):
+        """
+            Returns the total energy the snake would have if control point i was
+            moved to point, along with the re-computed terms of the affected window.
+            The cached state remains untouched.
+        """
+        spc, crv, ext = self.window(i)
+        if self.statistics is None:
+            statistics = None
+        else:
+            statistics = self.snake.ExternalEnergy.movedRegionStatistics(self.statistics, self.controlpoints, i, point)
+        old = self.controlpoints[i].copy()
+        self.controlpoints[i] = point
+        try:
+            # the terms of a window are computed from the slice of control
+            # points they depend on
+            spc_terms = spacingEnergies(self.controlpoints[spc[0]:spc[1]+1], self.snake.goal_length)[1]
+            crv_terms = curvatureEnergies(self.controlpoints[crv[0]:crv[1]+2])[1]
+            if self.contour:
+                ext_terms, len_terms = self.contourTerms(*ext)
+            else:
+                ext_terms = self.externalTerms(*ext)
+                len_terms = None
+        finally:
+            self.controlpoints[i] = old
+        spacing = self.spacing + (spc_terms - self.spc_energies[spc[0]:spc[1]]).sum()
+        curvature = self.curvature + (crv_terms - self.crv_energies[crv[0]:crv[1]]).sum()
+        external = self.external + (ext_terms - self.ext_energies[ext[0]:ext[1]]).sum()
+        if self.contour:
+            length = self.length + (len_terms - self.lengths[ext[0]:ext[1]]).sum()
+        else:
+            length = None
+        return self.total(spacing, curvature, external, statistics, length), (spc_terms, crv_terms, ext_terms, len_terms, statistics)
+
+    def move(self, i, point, terms=None):
+        """
+            Moves control point i to point and updates the cached terms of the
+            affected window. 'terms' may be the terms returned by trial().
+        """
+        if terms is None:
+            energy, terms = self.trial(i, point)
+        spc, crv, ext = self.window(i)
+        spc_terms, crv_terms, ext_terms, len_terms, statistics = terms
+        self.controlpoints[i] = point
+        self.spacing += (spc_terms - self.spc_energies[spc[0]:spc[1]]).sum()
+        self.spc_energies[spc[0]:spc[1]] = spc_terms
+        self.curvature += (crv_terms - self.crv_energies[crv[0]:crv[1]]).sum()
+        self.crv_energies[crv[0]:crv[1]] = crv_terms
+        self.external += (ext_terms - self.ext_energies[ext[0]:ext[1]]).sum()
+        self.ext_energies[ext[0]:ext[1]] = ext_terms
+        if self.contour:
+            self.length += (len_terms - self.lengths[ext[0]:ext[1]]).sum()
+            self.lengths[ext[0]:ext[1]] = len_terms
+        self.statistics = statistics
+
+def differenceBands(n, coefficients):
+    """
+        Returns D^T*D in lower banded storage, where D is the finite difference
+        operator with the given coefficients, e.g. [-1, 1] for the first and
+        [1, -2, 1] for the second difference, applied to n points of an open snake.
+        The k-th row holds the k-th subdiagonal.
+    """
+    r = len(coefficients)-1
+    bands = np.zeros((r+1, n))
+    rows = np.arange(max(n-r, 0))
+    for a in range(r+1):
+        for b in range(a, r+1):
+            bands[b-a, rows+a] += coefficients[a]*coefficients[b]
+    return bands
+
+def systemMatrix(n, alpha, beta, step):
+    """
+        Returns the banded Cholesky factor of the pentadiagonal system matrix
+        I + step*(alpha*D1^T*D1 + beta*D2^T*D2) of the semi-implicit (Kass et al.)
+        snake solver for n control points, where D1 and D2 are the first and
+        second difference operators. The factor is computed once per
+        (n, alpha, beta, step) and cached.
+    """
+    key = (n, alpha, beta, step)
+    if not key in _system_matrices:
+        bands = np.zeros((3, n))
+        bands[:2] += alpha*differenceBands(n, [-1.0, 1.0])
+        bands += beta*differenceBands(n, [1.0, -2.0, 1.0])
+        bands *= step
+        bands[0] += 1.0
+        _system_matrices[key] = cholesky_banded(bands, lower=True)
+    return _system_matrices[key]
+
+def semiImplicitStep(controlpoints, forces, alpha, beta, step):
+    """
+        Performs one step x <- A^-1 * (x + step*forces) of the semi-implicit
+        snake solver on the (N, 2) array of control points and returns the
+        new control points.
+    """
+    factor = systemMatrix(len(controlpoints), alpha, beta, step)
+    return cho_solve_banded((factor, True), controlpoints + step*forces)
@@ -281,7 +281,7 @@ class SnakeIslandMainWindow(QMainWindow, Ui_MainWindow):
             snake = self.ui.qimageviewer.snake_ref
             # create a dictionairy containing the necessary properties for
             # recreating the snake, i.e. controlpoints and flip-flag
-            snakeson = {'controlpoints': snake.controlpoints, 'flip': snake.flip}
+            snakeson = {'controlpoints': snake.controlpoints.tolist(), 'flip': snake.flip}
             # dump to json string
             jsonstring = json.dumps(snakeson)
             # write to desired file
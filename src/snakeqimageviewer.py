@@ -38,6 +38,7 @@ class SnakeQImageViewer(QImageViewer):
         self.brightness = 1
         self.snakemanualmode = True
         self.hide_snake_ref = False
+        self.externalenergy = None
                         
     def switchSnakeMode(self):
         self.snakemanualmode = not self.snakemanualmode
@@ -222,7 +223,7 @@ class SnakeQImageViewer(QImageViewer):
         self.snake.reset()
         self.snake_ref.reset()
         
-        assert self.snake.controlpoints == []
+        assert len(self.snake.controlpoints) == 0
         assert self.snake.contour == []
         
         self.update()
@@ -311,6 +312,7 @@ class SnakeQImageViewer(QImageViewer):
         self.image_shape = image_shape
         
         self.externalenergy = instantiateExternalEnergy(self.mainwindow.getExternalEnergy(), self.image)
+        self.externalenergy.setMapFeatures(filter(lambda mf: mf.visible, self.mapfeatures))
         
         # init a snake with the according goal length and external energy
         self.snake = Snake(qimageviewer=self,
@@ -509,6 +511,9 @@ class SnakeQImageViewer(QImageViewer):
         brightened = vigra.colors.brightness(self.image_display, factor = self.brightness)
         self.setImage(brightened.qimage())
         self.updateMapFeatureHeads()
+        # the external energy may use the visible map features as a prior
+        if self.externalenergy is not None:
+            self.externalenergy.setMapFeatures(filter(lambda mf: mf.visible, self.mapfeatures))
         
     def updateMapFeatureHeads(self):
         self.mapfeatureheads = []
@@ -2,11 +2,15 @@
 # /usr/bin/python
 
 import numpy as np
-from scipy.interpolate import splprep, splev, spalde
+from scipy.interpolate import splprep, splev
 from scipy.spatial.distance import euclidean
 from PyQt4.QtCore import QPoint
 from utils import *
 from numpy import pi
+from collections import OrderedDict
+import hashlib
+from configuration import DEF_SPLINECACHESIZE
+from snakeenergy import asControlPointArray, chordNormals, catmullRomNeighbours, catmullRomPoints, catmullRomDerivatives
 
 class Spline():
     
@@ -52,30 +56,26 @@ class Spline():
             self.interpolation.append((out[0][i], out[1][i]))
             
         self.tck = tck
+        # the spline parameters of the control points and of the interpolation
+        self.u = u
+        self.interpolation_u = unew
         self.normals = self.getNormals()
         
         assert len(self.controlpoints) == len(self.normals)
     
-    def getNormals(self):
-        normals = []
-        for point in self.controlpoints:
-            normals.append(self.getNormal(point))
-        return normals
-    
-    def getNormal(self, point):
-        best = self.controlpoints[0]
-        spot = 0
-        for i in np.linspace(0, 1, 50):
-            sa = spalde(float(i), self.tck)
-            new = (sa[0][0], sa[1][0])
-            if euclidean(point, new) < euclidean(point, best):
-                best = new
-                spot = i
-        
-        sa = spalde(float(spot), self.tck)
-        dvector = np.array([sa[0][1], sa[1][1]])
-        normal = normalizeVector(rotateVector(dvector, angle=.5*pi))
-        return normal
+    def getNormals(self, u=None):
+        """
+            Returns the (N, 2) array of unit normals of the spline at the parameters
+            u, which default to the parameters of the control points. All normals
+            are evaluated at once from the first derivative of the spline. The
+            normals along the interpolation are given by u=interpolation_u.
+        """
+        if u is None:
+            u = self.u
+        dx, dy = splev(np.atleast_1d(u), self.tck, der=1)
+        # rotate the derivatives by 90°
+        normals = np.column_stack((-np.asarray(dy), np.asarray(dx)))
+        return normals/np.sqrt((normals**2).sum(axis=1))[:, np.newaxis]
             
     def reset(self):
         self.controlpoints = []
@@ -85,4 +85,175 @@ class Spline():
         return u'<Spline: %s controlpoints>' % len(self.controlpoints)
     
     def __str__(self):
-        return u'<Spline with %s controlpoints>' % len(self.controlpoints)
\ No newline at end of file
+        return u'<Spline with %s controlpoints>' % len(self.controlpoints)
+
+class CatmullRomSpline(Spline):
+    """
+        A uniform Catmull-Rom spline through the control points. Other than the
+        smoothing spline of Spline each segment only depends on the two control
+        points it connects and their neighbours. The first and the last control
+        point get mirrored neighbours.
+        
+        Moving a control point therefore only changes the four adjacent segments
+        and the normals of the control point and its neighbours, which get patched
+        in place by moveControlPoint(). The tangent at a control point is parallel
+        to the chord between its neighbours, i.e. the normals are the very same as
+        those of snakeenergy.chordNormals.
+    """
+    
+    def __init__(self):
+        Spline.__init__(self)
+        self.controlpoints = asControlPointArray([])
+        self.normals = chordNormals(self.controlpoints)
+        # the number of interpolation samples of each segment
+        self.lengths = []
+        self.interpolation_u = []
+        
+    def addControlPoints(self, *controlpoints):
+        n = len(self.controlpoints)
+        self.controlpoints = np.vstack((self.controlpoints, asControlPointArray(controlpoints)))
+        # the former last segment and normal depend on the new control points
+        self.lengths.extend([0]*(len(self.controlpoints)-1-len(self.lengths)))
+        self.normals = np.vstack((self.normals, np.zeros((len(controlpoints), 2))))
+        self.patch(n-2, len(self.controlpoints)-2, n-1, len(self.controlpoints)-1)
+        
+    def update(self):
+        self.lengths = [0]*max(len(self.controlpoints)-1, 0)
+        self.interpolation = []
+        self.interpolation_u = []
+        self.normals = np.zeros((len(self.controlpoints), 2))
+        self.patch(0, len(self.controlpoints)-2, 0, len(self.controlpoints)-1)
+        
+    def moveControlPoint(self, i, point):
+        """
+            Moves control point i to point and patches the four adjacent segments
+            and the three affected normals.
+        """
+        self.controlpoints[i] = point
+        self.patch(i-2, i+1, i-1, i+1)
+        
+    def patch(self, first, last, first_normal, last_normal):
+        """
+            Re-evaluates the segments first to last and the normals first_normal
+            to last_normal and replaces them within the interpolation and the
+            normals.
+        """
+        n = len(self.controlpoints)
+        first = max(first, 0)
+        last = min(last, n-2)
+        if first <= last:
+            start = sum(self.lengths[:first])
+            end = start + sum(self.lengths[first:last+1])
+            samples = []
+            samples_u = []
+            for j in range(first, last+1):
+                points, u = self.segment(j)
+                self.lengths[j] = len(points)
+                samples.extend(zip(points[:, 0], points[:, 1]))
+                samples_u.extend(u)
+            self.interpolation[start:end] = samples
+            self.interpolation_u[start:end] = samples_u
+        
+        first_normal = max(first_normal, 0)
+        last_normal = min(last_normal, n-1)
+        if first_normal <= last_normal:
+            # the normals only depend on the direct neighbours
+            lo = max(first_normal-1, 0)
+            normals = chordNormals(self.controlpoints[lo:last_normal+2])
+            self.normals[first_normal:last_normal+1] = normals[first_normal-lo:last_normal-lo+1]
+        
+    def neighbours(self, j):
+        """
+            Returns the four control points segment j depends on as (K, 2) arrays,
+            where j may be an int or an array of K segment indices.
+        """
+        return catmullRomNeighbours(self.controlpoints, j)
+        
+    def segment(self, j):
+        """
+            Returns the interpolation samples of segment j, i.e. between the control
+            points j and j+1, along with their parameters.
+        """
+        p0, p1, p2, p3 = self.neighbours(j)
+        distance = euclidean(p1[0], p2[0])
+        t = np.linspace(0, 1, int(distance/10))[:, np.newaxis]
+        points = catmullRomPoints(p0, p1, p2, p3, t)
+        return points, j + t[:, 0]
+    
+    def getNormals(self, u=None):
+        """
+            Returns the (N, 2) array of unit normals at the parameters u, which
+            default to the control points. The parameter of a point on segment j
+            is j+t with t within [0, 1].
+        """
+        if u is None:
+            return self.normals
+        u = np.atleast_1d(np.asarray(u, dtype=np.float64))
+        j = np.clip(np.floor(u).astype(int), 0, len(self.controlpoints)-2)
+        t = (u - j)[:, np.newaxis]
+        p0, p1, p2, p3 = self.neighbours(j)
+        d = catmullRomDerivatives(p0, p1, p2, p3, t)
+        # rotate the derivatives by 90°
+        normals = np.column_stack((-d[:, 1], d[:, 0]))
+        return normals/np.sqrt((normals**2).sum(axis=1))[:, np.newaxis]
+    
+    def reset(self):
+        self.controlpoints = asControlPointArray([])
+        self.update()
+    
+class SplineCache(object):
+    """
+        A bounded least recently used cache of splines. A spline is looked up by a
+        hash of the array of its control points, so the spline fit, the
+        interpolation and the normals of a configuration of control points that
+        has been seen before get reused. The number of hits and misses is
+        counted.
+        
+        The cached splines are shared and must not be altered.
+    """
+    
+    def __init__(self, size=DEF_SPLINECACHESIZE):
+        self.size = size
+        self.splines = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        
+    def key(self, controlpoints):
+        """
+            Returns the hash of the given control points.
+        """
+        return hashlib.sha1(asControlPointArray(controlpoints).tostring()).hexdigest()
+    
+    def getSpline(self, controlpoints):
+        """
+            Returns the spline through the given control points, either from the
+            cache or newly fitted.
+        """
+        key = self.key(controlpoints)
+        if key in self.splines:
+            self.hits += 1
+            # re-insert the spline as the most recently used one
+            spline = self.splines.pop(key)
+        else:
+            self.misses += 1
+            spline = Spline()
+            spline.addControlPoints(*controlpoints)
+            # drop the least recently used spline if the cache is full
+            if len(self.splines) >= self.size:
+                self.splines.popitem(last=False)
+        self.splines[key] = spline
+        return spline
+    
+    def clear(self):
+        """
+            Empties the cache and resets the counters.
+        """
+        self.splines.clear()
+        self.hits = 0
+        self.misses = 0
+        
+    def __str__(self):
+        return '<SplineCache: %s/%s splines, %s hits, %s misses>' % (len(self.splines), self.size, self.hits, self.misses)
+
+# the cache shared by all snakes
+splinecache = SplineCache()
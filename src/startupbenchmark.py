@@ -0,0 +1,67 @@
+# -*- coding=utf-8 -*-
+# /usr/bin/python
+
+"""
+    Measures how long importing the modules takes, each in a fresh
+    interpreter, and whether the import pulls in matplotlib. Reports JSON,
+    e.g.
+
+        python startupbenchmark.py --limit 1.0
+        python startupbenchmark.py --module externalenergy --repeat 5
+"""
+
+import os
+import sys
+import json
+import subprocess
+from optparse import OptionParser
+
+# the modules a batch worker imports
+DEF_MODULES = ['msgradients', 'scalespace', 'externalenergy', 'snake', 'utils']
+
+# runs within the fresh interpreter
+_SCRIPT = '''
+import sys, json
+from time import time
+start = time()
+import %s
+print json.dumps({'seconds': time() - start, 'matplotlib': 'matplotlib' in sys.modules})
+'''
+
+def importTime(module):
+    """
+        Returns the seconds importing the module takes in a fresh interpreter
+        and whether matplotlib got imported along.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.check_output([sys.executable, '-c', _SCRIPT % module], cwd=directory)
+    result = json.loads(output.strip().splitlines()[-1])
+    return result['seconds'], result['matplotlib']
+
+def benchmark(modules, repeat=3):
+    """
+        Returns the best import time of each module out of 'repeat' runs as
+        dictionary.
+    """
+    results = {}
+    for module in modules:
+        runs = [importTime(module) for i in range(repeat)]
+        results[module] = {'seconds': min(seconds for seconds, matplotlib in runs),
+                           'matplotlib': any(matplotlib for seconds, matplotlib in runs)}
+    return results
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--module', action='append', dest='modules',
+                      help='module to import, may be given multiple times, defaults to %s' % ', '.join(DEF_MODULES))
+    parser.add_option('--repeat', type='int', default=3, help='imports per module, the fastest one counts')
+    parser.add_option('--limit', type='float', default=None,
+                      help='seconds an import may take at most, exits with 1 if exceeded')
+    options, args = parser.parse_args()
+
+    results = benchmark(options.modules or DEF_MODULES, options.repeat)
+    print json.dumps(results, indent=2, sort_keys=True)
+    slow = [module for module in results if options.limit is not None and results[module]['seconds'] > options.limit]
+    for module in slow:
+        print >> sys.stderr, '%s takes %.2f s to import' % (module, results[module]['seconds'])
+    sys.exit(1 if slow else 0)
@@ -41,25 +41,19 @@ def getS57Features(geoimage, s57data, roi, feature_name, feature_type=None, feat
                 (check www.s-57.com for further s57 map features)
                 
     """
-    features = s57data.getFeaturesForLayerByName(feature_name, feature_type=feature_type, feature_value=feature_value)
+    # the vertices of all features and the offsets of each feature
+    vertices, offsets = s57data.getFeaturesForLayerByName(feature_name, feature_type=feature_type, feature_value=feature_value)
     topleft = roi[0]
     bottomright = roi[1]
     xsize = abs(bottomright[0] - topleft[0])
     ysize = abs(bottomright[1] - topleft[1])
     coordinates = []
-    for i in features:
+    for k in range(len(offsets)-1):
         cs = []
-        for c in filter(lambda x: isinstance(x, list), i['coordinates']):
-            if len(c) > 2:
-                c = filter(lambda x: not isinstance(x, float), c)
-                for c in c:
-                    mapping = geoimage.mapToImage(c)
-                    if mapping != None:
-                        cs.append(mapping)
-            else:
-                mapping = geoimage.mapToImage(c)
-                if mapping != None:
-                    cs.append(mapping)
+        for c in vertices[offsets[k]:offsets[k+1]].tolist():
+            mapping = geoimage.mapToImage(c)
+            if mapping != None:
+                cs.append(mapping)
         # clip features
         cs = filter(lambda c: geoimage.withInROI(roi, c), cs)
         # map features into image
@@ -238,6 +232,9 @@ def getExternalEnergyClassesList():
 	# list of external energies available in the 'externalenergy' module
 	energyclasses = []
 	for energyclass in inspect.getmembers(externalenergy, inspect.isclass):
+		# skip helper classes the module imports, e.g. the scale space filters
+		if not issubclass(energyclass[1], externalenergy.ExternalEnergy):
+			continue
 		energyclasses.append(energyclass[0])
 	energyclasses.reverse()
 	return energyclasses